@@ -1,25 +1,158 @@
 from __future__ import with_statement
 
-import cgi
+import copy
+import ctypes
+import ctypes.util
+import errno
+import gc
 import hashlib
+import imp
+import itertools
+import marshal
+import multiprocessing
 import os
 import re
+import struct
+import sys
+import tempfile
 import threading
+import time
 import types
+from collections import deque
 
 try:
     import cStringIO as StringIO
 except ImportError:
     import StringIO
 
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
-TAG_TYPES = ur"#\^/=!<>&{"
+
+TAG_TYPES = ur"#\^/=!<>&{*"
 DEF_OTAG = u"{{"
 DEF_CTAG = u"}}"
 ANY_CONTENT = (u"!", u"=")
-SKIP_WHITESPACE = (u"#", u"^", u"/", u"<", u">", u"=", u"!")
+SKIP_WHITESPACE = (u"#", u"^", u"/", u"<", u">", u"=", u"!", u"*")
 TAG_CONTENT_RE = ur"[\w?!\/\-]*?([\w?!\/\-]\^*)?(\.[\w?!\/\-]+)*"
+# Matches a whole tag: leading whitespace when the tag starts a line,
+# the open tag, the tag type, the tag content, an optional repeat of the
+# tag type and the close tag.
+TAG_RE = (ur"(?P<pad>^[ \t]+)?%s\s*"
+          ur"(?:(?P<brace>\{)|(?P<caret>\^)|(?P<type>[#/=!<>&*]))?"
+          ur"\s*(?P<content>.*?)\s*"
+          ur"(?(brace)(?:\}|(?!\})))(?(type)(?P=type)?)%s")
+STANDALONE_RE = re.compile(ur"[ \t]*\n")
 NOT_FOUND = object()
+FUTURE_TYPES = {}
+# Names and short static strings are shared by all the templates that use
+# them through SHARED, which is emptied when it holds MAX_SHARED values.
+SHARED = {}
+MAX_SHARED = 65536
+MAX_SHARED_STATIC = 64
+SAFE_TYPES = {}
+# Escaped values are remembered in ESCAPE_MEMO, which is emptied when it
+# holds ESCAPE_MEMO_SIZE of them. Values longer than ESCAPE_MEMO_LENGTH
+# are not remembered.
+ESCAPE_MEMO = {}
+ESCAPE_MEMO_SIZE = 4096
+ESCAPE_MEMO_LENGTH = 1024
+
+
+def split_name(name):
+    """\
+    Turn a tag name into the lookup plan used by `ContextStack.resolve`.
+    The plan is the number of context levels to climb before the first
+    lookup and the tuple of names to look up in turn, so `a^^.b` becomes
+    `(2, (u"a", u"b"))`. Only the first name may climb the context, as
+    required by TAG_CONTENT_RE.
+    """
+    parts = tuple(part.rstrip(u"^") for part in name.split(u"."))
+    return (len(name.split(u".", 1)[0]) - len(parts[0]), parts)
+
+
+def shared(value):
+    """\
+    Return a value equal to `value` that is shared with the templates
+    parsed before, so that names and markup repeated across templates
+    are only kept once.
+    """
+    ret = SHARED.get(value)
+    if ret is None:
+        if len(SHARED) >= MAX_SHARED:
+            SHARED.clear()
+        ret = SHARED[value] = value
+    return ret
+
+
+def is_future(obj):
+    """\
+    Check if `obj` is a future, ie. has `result` and `add_done_callback`
+    methods like the futures of `concurrent.futures`. The answer is kept
+    per type so that plain values are told apart with a dict lookup.
+    """
+    cls = type(obj)
+    ret = FUTURE_TYPES.get(cls)
+    if ret is None:
+        ret = hasattr(cls, "result") and hasattr(cls, "add_done_callback")
+        FUTURE_TYPES[cls] = ret
+    return ret
+
+
+def escape(data):
+    """\
+    Escape `data` for use in HTML, with the same output as
+    `cgi.escape(data, quote=True)`. Strings without any of the special
+    characters are returned as is and the others are remembered so that
+    values repeated across a page are only escaped once.
+    """
+    if u"&" in data or u"<" in data or u">" in data or u'"' in data:
+        ret = ESCAPE_MEMO.get(data)
+        if ret is None:
+            ret = data.replace(u"&", u"&amp;").replace(u"<", u"&lt;")
+            ret = ret.replace(u">", u"&gt;").replace(u'"', u"&quot;")
+            if len(data) <= ESCAPE_MEMO_LENGTH:
+                if len(ESCAPE_MEMO) >= ESCAPE_MEMO_SIZE:
+                    ESCAPE_MEMO.clear()
+                ESCAPE_MEMO[data] = ret
+        return ret
+    return data
+
+
+def is_safe(obj):
+    """\
+    Check if `obj` is already escaped, ie. has an `__html__` method like
+    `Safe` strings or the markup types of other libraries. The answer is
+    kept per type like for `is_future`.
+    """
+    cls = type(obj)
+    ret = SAFE_TYPES.get(cls)
+    if ret is None:
+        ret = SAFE_TYPES[cls] = hasattr(cls, "__html__")
+    return ret
+
+
+def should_call(func, args=0):
+    """\
+    Check if `func` is a callable value that takes `args` arguments.
+    """
+    if isinstance(func, (types.BuiltinFunctionType, types.FunctionType)):
+        return func.func_code.co_argcount == args
+    elif isinstance(func, (types.BuiltinMethodType, types.MethodType)):
+        return func.func_code.co_argcount - 1 == args
+    else:
+        return callable(func)
+
+
+class Safe(unicode):
+    """\
+    A unicode string that is rendered as is by escaped tags, for values
+    that are already valid HTML.
+    """
+    def __html__(self):
+        return self
 
 # Exceptions
 
@@ -76,11 +209,46 @@ class LookupError(PystacheError):
         return u"LookupError: %s" % self.mesg
 
 
+class PreloadError(PystacheError):
+    def __init__(self, errors):
+        # A list of (template name, exception) pairs.
+        self.errors = errors
+
+    def __str__(self):
+        lines = [u"PreloadError: %d template(s) failed to load" %
+                    len(self.errors)]
+        for name, inst in self.errors:
+            lines.append(u"  %s: %s" % (name, inst))
+        return u"\n".join(lines)
+
+
+class BudgetExceeded(PystacheError):
+    def __init__(self, limit, progress):
+        # The name of the RenderBudget limit that was reached.
+        self.limit = limit
+        # How far the render got, see `BudgetStack.progress`.
+        self.progress = progress
+        # The output written before the limit was reached, when the
+        # render method collected it.
+        self.output = None
+
+    def __str__(self):
+        progress = self.progress
+        mesg = (u"BudgetExceeded: %s reached after %d bytes, %d iterations "
+                u"and %.3fs" % (self.limit, progress["bytes"],
+                    progress["iterations"], progress["elapsed"]))
+        if progress["partials"]:
+            mesg += u" in partial %s" % u" > ".join(progress["partials"])
+        return mesg
+
+
 class Tag(object):
     """\
     An internal object emitted by the tokenizer and consumed by
     the template parsing to create templates.
     """
+    __slots__ = ("tagtype", "name", "start", "end")
+
     def __init__(self, tagtype, name, start, end):
         self.tagtype = tagtype
         self.name = name
@@ -92,13 +260,36 @@ class Renderable(object):
     """\
     Root class of a shallow class hiearchy responsible for representing
     a parsed template.
+
+    Nodes use __slots__ to keep parsed templates small, and only the ones
+    that need their template, to find partials or the source of lambda
+    sections, keep a reference to it.
     """
+    __slots__ = ()
+
     def __init__(self, template):
-        self.template = template
+        pass
 
     def render(self, ctx, writer):
         raise NotImplementedError()
 
+    def stream(self, ctx, writer):
+        """\
+        Render this node to `writer` in steps, returning an iterable
+        that renders up to the next step each time it advances. Nodes
+        that only write a bounded amount of output render at once and
+        return an empty tuple.
+        """
+        self.render(ctx, writer)
+        return ()
+
+    def dump(self):
+        """\
+        Return a tuple describing this node that can be serialized with
+        `marshal`. See `Template.restore` for the reverse operation.
+        """
+        raise NotImplementedError()
+
 
 class Static(Renderable):
     """\
@@ -109,26 +300,43 @@ class Static(Renderable):
         
     Has three Static nodes: "Items ", ".", and " done."
     """
+    __slots__ = ("data",)
+
     def __init__(self, template, data):
         super(Static, self).__init__(template)
+        if len(data) <= MAX_SHARED_STATIC:
+            data = shared(data)
         self.data = data
 
     def render(self, ctx, writer):
         writer.write(self.data)
 
+    def dump(self):
+        return ("static", self.data)
+
 
 class Partial(Renderable):
     """\
     Partials are sub-templates that are evaluated and rendered during
     the render phase of a template (as opposed to parse phase).
     """
+    __slots__ = ("template", "name")
+
     def __init__(self, template, name):
         super(Partial, self).__init__(template)
-        self.name = name
+        self.template = template
+        self.name = shared(name)
 
     def render(self, ctx, writer):
         tmpl = self.template.get_partial(self.name)
-        return tmpl.render(ctx, writer)
+        return ctx.render_partial(self.name, tmpl, writer)
+
+    def stream(self, ctx, writer):
+        tmpl = self.template.get_partial(self.name)
+        return ctx.stream_partial(self.name, tmpl, writer)
+
+    def dump(self):
+        return ("partial", self.name)
 
 
 class Value(Renderable):
@@ -136,14 +344,22 @@ class Value(Renderable):
     Value nodes are a representation of simple variable substitution
     using tags like {{foo}} or {{{foo}}}.
     """
+    __slots__ = ("name", "plan", "pushes", "escaped")
+
     def __init__(self, template, name, escaped=True):
         super(Value, self).__init__(template)
-        self.name = name
+        self.name = shared(name)
+        self.plan = shared(split_name(name))
+        self.pushes = len(self.plan[1]) - 1
         self.escaped = escaped
 
     def render(self, ctx, writer):
-        ctx = ctx.get(self.name)
-        ctx.render(writer, escaped=self.escaped)
+        value = ctx.resolve(self.plan)
+        ctx.write(value, writer, escaped=self.escaped)
+        ctx.unwind(self.pushes)
+
+    def dump(self):
+        return ("value", self.name, self.escaped)
 
 
 class Multi(Renderable):
@@ -152,6 +368,8 @@ class Multi(Renderable):
     conditionally. Currently only the internal root node and sections
     have this property.
     """
+    __slots__ = ("parent", "sects")
+
     def __init__(self, template, parent):
         super(Multi, self).__init__(template)
         self.parent = parent
@@ -161,9 +379,22 @@ class Multi(Renderable):
         self.sects.append(obj)
         return obj
 
+    def freeze(self):
+        # Sub-nodes are only added while the tree is built, after which
+        # they are kept in a tuple.
+        self.sects = tuple(self.sects)
+
     def render(self, ctx, writer):
         map(lambda s: s.render(ctx, writer), self.sects)
 
+    def stream(self, ctx, writer):
+        for sect in self.sects:
+            for step in sect.stream(ctx, writer):
+                yield step
+
+    def dump(self):
+        return ("multi", tuple(s.dump() for s in self.sects))
+
 
 class Section(Multi):
     """\
@@ -171,22 +402,279 @@ class Section(Multi):
     rendered, rendered multiple times, or passed to a callable to
     be evaluated.
     """
+    __slots__ = ("template", "name", "plan", "pushes", "start", "end")
+
     def __init__(self, template, parent, name, start):
         super(Section, self).__init__(template, parent)
-        self.name = name
+        self.template = template
+        self.name = shared(name)
+        self.plan = shared(split_name(name))
+        self.pushes = len(self.plan[1]) - 1
         self.start = start
         self.end = None
 
     def render(self, ctx, writer):
-        ctx = ctx.get(self.name)
-        if ctx.falsy():
-            return
-        elif ctx.islambda():
+        value = ctx.resolve(self.plan)
+        if value:
+            self.render_value(ctx, value, writer)
+        ctx.unwind(self.pushes)
+
+    def render_value(self, ctx, value, writer):
+        """\
+        Render the section for `value`, the truthy value its name was
+        resolved to.
+        """
+        ctx.push(value)
+        if ctx.islambda(value):
             content = self.template.sub_data(self.start, self.end)
-            ctx.execute(content, ctx, writer)
+            ctx.execute(value, content, writer)
+        elif (value.__class__ is Columns
+                and self.render_columns(ctx, value, writer)):
+            pass
         else:
-            for item in ctx.iterate():
-                super(Section, self).render(item, writer)
+            for item in ctx.iterate(value):
+                ctx.push(item)
+                super(Section, self).render(ctx, writer)
+                ctx.pop()
+        ctx.pop()
+
+    def stream(self, ctx, writer):
+        value = ctx.resolve(self.plan)
+        if value:
+            ctx.push(value)
+            if ctx.islambda(value):
+                content = self.template.sub_data(self.start, self.end)
+                ctx.execute(value, content, writer)
+            elif (value.__class__ is Columns
+                    and self.render_columns(ctx, value, writer)):
+                pass
+            else:
+                for item in ctx.iterate(value):
+                    ctx.push(item)
+                    for step in super(Section, self).stream(ctx, writer):
+                        yield step
+                    ctx.pop()
+                    yield None
+            ctx.pop()
+        ctx.unwind(self.pushes)
+
+    def render_columns(self, ctx, table, writer):
+        """\
+        Render `table`, a Columns already pushed on the stack, column by
+        column. Each column used by a value is converted and escaped in
+        bulk, values that aren't columns are rendered once, and the
+        results are interleaved row by row. Returns False without
+        writing anything if the section holds more than text and values,
+        uses dotted names into the columns or has values that can't be
+        converted in bulk, in which case the rows are rendered one by
+        one instead.
+        """
+        parts = []
+        converted = {}
+        # Names that aren't columns miss the rows and are looked up
+        # further down the stack, so an empty dict stands for the row.
+        ctx.push({})
+        try:
+            for node in self.sects:
+                if node.__class__ is Static:
+                    part = node.data
+                elif node.__class__ is not Value:
+                    return False
+                elif node.plan[1][0] in table.columns:
+                    hops, names = node.plan
+                    if hops or len(names) > 1:
+                        return False
+                    key = (names[0], node.escaped)
+                    part = converted.get(key)
+                    if part is None:
+                        part = column_strings(table.columns[names[0]],
+                                        node.escaped, self.template.decode)
+                        if part is None:
+                            return False
+                        converted[key] = part
+                else:
+                    value = ctx.resolve(node.plan)
+                    ctx.unwind(node.pushes)
+                    if should_call(value):
+                        return False
+                    buf = Writer()
+                    ctx.write(value, buf, node.escaped)
+                    part = buf.getvalue()
+                if parts and part.__class__ is unicode is parts[-1].__class__:
+                    parts[-1] += part
+                else:
+                    parts.append(part)
+        finally:
+            ctx.pop()
+        ctx.count_items(len(table))
+        size = Columns.BLOCK
+        for start in xrange(0, len(table), size):
+            count = min(size, len(table) - start)
+            cols = [p[start:start + count] if p.__class__ is list
+                        else itertools.repeat(p, count) for p in parts]
+            writer.write(u"".join(map(u"".join, itertools.izip(*cols))))
+        return True
+
+    def dump(self):
+        sects = tuple(s.dump() for s in self.sects)
+        return ("section", self.name, self.start, self.end, sects)
+
+
+class CachedSection(Section):
+    """\
+    A Section whose output is kept in the `fragment_cache` of its
+    template, created for sections opened with a {{*name}} tag or named
+    in the `sections` of the fragment cache. On a hit the stored output
+    is written without looking up anything but the name of the section.
+    Sections that aren't entered write nothing and aren't cached. Without
+    a fragment cache it renders like a Section.
+    """
+    __slots__ = ()
+
+    def render(self, ctx, writer):
+        cache = self.template.opts.fragment_cache
+        if cache is None:
+            return super(CachedSection, self).render(ctx, writer)
+        key = cache.key(self, ctx)
+        value = ctx.resolve(self.plan)
+        if value:
+            data = cache.get(key)
+            if data is None:
+                buf = Writer()
+                self.render_value(ctx, value, buf)
+                data = buf.getvalue()
+                cache.put(key, data)
+            writer.write(data)
+        ctx.unwind(self.pushes)
+
+    def stream(self, ctx, writer):
+        # Cached output is written at once.
+        self.render(ctx, writer)
+        return ()
+
+    def dump(self):
+        sects = tuple(s.dump() for s in self.sects)
+        return ("cachedsection", self.name, self.start, self.end, sects)
+
+
+class ParallelSection(Section):
+    """\
+    A Section named in the `sections` of the `parallel` option of its
+    template. Its items are rendered in chunks by the executor of that
+    option and the outputs of the chunks are written in order. Without
+    an executor it renders like a Section.
+
+    Items are rendered on top of the values that the names used in the
+    section have outside of it rather than on top of the whole context
+    stack. Names that only appear in the output of lambdas are not found
+    outside of the items, and sections using name^ lookups, which depend
+    on the whole stack, render like a Section.
+    """
+    __slots__ = ()
+
+    def render(self, ctx, writer):
+        runner, names = self.runner(ctx)
+        if runner is None:
+            return super(ParallelSection, self).render(ctx, writer)
+        for step in self.write_chunks(runner, names, ctx, writer):
+            pass
+
+    def stream(self, ctx, writer):
+        runner, names = self.runner(ctx)
+        if runner is None:
+            return super(ParallelSection, self).stream(ctx, writer)
+        return self.write_chunks(runner, names, ctx, writer)
+
+    def runner(self, ctx):
+        """\
+        Return the ParallelRenderer for this section and the names used
+        in it, or a pair of None if it has to render like a Section.
+        """
+        runner = self.template.opts.parallel
+        if runner is None or runner.executor is None:
+            return None, None
+        # Profiled renders are timed, and budgeted ones counted, in this
+        # thread. Chunks render their parallel sections themselves, as
+        # waiting on tasks from a task can deadlock a thread pool.
+        if isinstance(ctx, (ProfilingStack, BudgetStack, ChunkStack)):
+            return None, None
+        names = self.names()
+        if names is None:
+            return None, None
+        return runner, names
+
+    def write_chunks(self, runner, names, ctx, writer):
+        value = ctx.resolve(self.plan)
+        if value and ctx.islambda(value):
+            ctx.push(value)
+            content = self.template.sub_data(self.start, self.end)
+            ctx.execute(value, content, writer)
+            ctx.pop()
+        elif value:
+            items = ctx.iterate(value)
+            # A value that is iterated over, which could be a generator,
+            # stays here and an empty tuple takes its place. Others are
+            # rendered once and go along.
+            frame = value
+            if not isinstance(items, list):
+                frame = ()
+            outer = self.outer(ctx, names, value, frame)
+            raises = ctx.raises()
+            for data in runner.chunks(self, outer, frame, raises, items):
+                writer.write(data)
+                yield None
+        ctx.unwind(self.pushes)
+
+    def outer(self, ctx, names, value, frame):
+        """\
+        Return a dict of the values `names` have outside of the section.
+        Chunks are rendered with this dict in place of the context stack
+        so that only the values they need are sent along.
+        """
+        ret = {}
+        for name in names:
+            try:
+                found = ctx.lookup(name)
+            except ContextMiss:
+                continue
+            if found is value:
+                found = frame
+            if found is not NOT_FOUND:
+                ret[name] = found
+        return ret
+
+    def names(self):
+        """\
+        Return the names in the tags of the section, partials included,
+        or None if any of them looks up the stack with ^. All the parts
+        of dotted names are included since the parts after the first
+        fall back to the stack too.
+        """
+        ret = set()
+        seen = []
+        stack = list(self.sects)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, (Value, Section, InvSection)):
+                hops, parts = node.plan
+                if hops:
+                    return None
+                ret.update(parts)
+            if node.__class__ is Partial:
+                try:
+                    tmpl = node.template.get_partial(node.name)
+                except PystacheError:
+                    continue
+                if tmpl not in seen:
+                    seen.append(tmpl)
+                    stack.append(tmpl.root)
+            elif isinstance(node, Multi):
+                stack.extend(node.sects)
+        return ret
+
+    def dump(self):
+        sects = tuple(s.dump() for s in self.sects)
+        return ("parallelsection", self.name, self.start, self.end, sects)
 
 
 class InvSection(Multi):
@@ -194,16 +682,120 @@ class InvSection(Multi):
     An InvSection (inverted section) is part of a template that is
     rendered when its tag evalutes as falsy.
     """
+    __slots__ = ("name", "plan", "pushes", "start", "end")
+
     def __init__(self, template, parent, name, start):
         super(InvSection, self).__init__(template, parent)
-        self.name = name
+        self.name = shared(name)
+        self.plan = shared(split_name(name))
+        self.pushes = len(self.plan[1]) - 1
         self.start = start
         self.end = None
 
     def render(self, ctx, writer):
-        ctx = ctx.get(self.name)
-        if ctx.falsy():
+        value = ctx.resolve(self.plan)
+        if not value:
+            ctx.push(value)
             super(InvSection, self).render(ctx, writer)
+            ctx.pop()
+        ctx.unwind(self.pushes)
+
+    def stream(self, ctx, writer):
+        value = ctx.resolve(self.plan)
+        if not value:
+            ctx.push(value)
+            for step in super(InvSection, self).stream(ctx, writer):
+                yield step
+            ctx.pop()
+        ctx.unwind(self.pushes)
+
+    def dump(self):
+        sects = tuple(s.dump() for s in self.sects)
+        return ("invsection", self.name, self.start, self.end, sects)
+
+
+class Inline(Multi):
+    """\
+    An Inline node holds the nodes of a partial that was spliced into
+    the template using it by `Template.inline`. It renders exactly like
+    the Partial node it replaces without looking the partial up.
+    """
+    __slots__ = ("template", "name")
+
+    def __init__(self, template, parent, name):
+        super(Inline, self).__init__(template, parent)
+        self.template = template
+        self.name = name
+
+
+class Columns(object):
+    """\
+    A table of equal length columns to render with a section, given as
+    a dict of column names to sequences such as lists, NumPy arrays or
+    `array.array` buffers. Arrays are converted with their `tolist`
+    method.
+
+    Sections that only hold text and values render a table column by
+    column, see `Section.render_columns`, which is much faster than
+    rendering it row by row. Other sections iterate over it as a list of
+    dicts, one per row, with the same output.
+    """
+    # The number of rows joined at a time.
+    BLOCK = 4096
+
+    def __init__(self, columns):
+        self.columns = {}
+        self.length = None
+        for name, column in columns.iteritems():
+            if hasattr(column, "tolist"):
+                column = column.tolist()
+            else:
+                column = list(column)
+            if self.length is None:
+                self.length = len(column)
+            elif len(column) != self.length:
+                raise ValueError("Column %s has %d rows instead of %d" %
+                                    (name, len(column), self.length))
+            self.columns[name] = column
+        self.length = self.length or 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        names = list(self.columns)
+        columns = [self.columns[name] for name in names]
+        for row in itertools.izip(*columns):
+            yield dict(itertools.izip(names, row))
+
+
+# The types of the column values that are converted in bulk.
+COLUMN_TYPES = set([unicode, str, int, long, float, bool, type(None)])
+
+
+def column_strings(column, escaped, decode):
+    """\
+    Convert the values of a column to unicode with `decode`, escaping
+    them if `escaped` is set, like `ContextStack.write` would one by one.
+    Returns None for columns holding values of other types than those of
+    COLUMN_TYPES.
+    """
+    types = set(map(type, column))
+    if not types <= COLUMN_TYPES:
+        return None
+    if types == set([unicode]):
+        ret = column
+    else:
+        ret = [v if v.__class__ is unicode else decode(v) for v in column]
+    if escaped and ret:
+        # Escape the whole column at once, unless it holds the
+        # separator.
+        joined = u"\0".join(ret)
+        if joined.count(u"\0") == len(ret) - 1:
+            ret = escape(joined).split(u"\0")
+        else:
+            ret = map(escape, ret)
+    return list(ret)
 
 
 class Writer(object):
@@ -229,6 +821,329 @@ class Writer(object):
         return ret
 
 
+class ChunkWriter(Writer):
+    """\
+    The writer used by `Template.iter_render`. It keeps count of the
+    characters written so that the buffer can be handed out in chunks
+    while the template is still rendering.
+    """
+    def __init__(self):
+        super(ChunkWriter, self).__init__()
+        self.size = 0
+
+    def write(self, data):
+        assert isinstance(data, unicode)
+        self.buf.append(data)
+        self.size += len(data)
+
+    def flush(self):
+        ret = self.getvalue()
+        self.buf = []
+        self.size = 0
+        return ret
+
+
+class ByteWriter(object):
+    """\
+    A writer that encodes the output as it is written, for use with
+    `Template.render_bytes`. Besides `write(data)` for unicode data it
+    has `write_bytes(data)` for data that is already encoded.
+
+    charset     - The encoding of the output.
+    target      - Where to write the output. By default it is collected
+                  in a bytearray returned by `getvalue`. A bytearray is
+                  appended to, a memoryview is filled from its start and
+                  anything else is expected to be a file with a `write`
+                  method or a socket with a `sendall` method. Files and
+                  sockets are written to in blocks of `bufsize` bytes
+                  when `flush` is not called in between.
+    errors      - The action to take for characters that can't be encoded.
+                  Default is `strict`.
+
+    `size` is the number of bytes written so far.
+    """
+    def __init__(self, charset="utf-8", target=None, errors="strict",
+                    bufsize=65536):
+        self.charset = charset
+        self.errors = errors
+        self.bufsize = bufsize
+        self.written = 0
+        self.out = None
+        self.fixed = isinstance(target, memoryview)
+        if target is None:
+            self.buf = bytearray()
+        elif isinstance(target, bytearray):
+            self.buf = target
+            self.written = -len(target)
+        elif self.fixed:
+            self.buf = target
+            self.write_bytes = self.fill
+            return
+        else:
+            self.buf = bytearray()
+            self.out = getattr(target, "write", None) or target.sendall
+            self.write_bytes = self.buffer
+            return
+        # Appending to a bytearray needs no bookkeeping.
+        self.write_bytes = self.buf.extend
+
+    @property
+    def size(self):
+        if self.fixed:
+            return self.written
+        return self.written + len(self.buf)
+
+    def write(self, data):
+        assert isinstance(data, unicode)
+        self.write_bytes(data.encode(self.charset, self.errors))
+
+    def buffer(self, data):
+        self.buf.extend(data)
+        if len(self.buf) >= self.bufsize:
+            self.flush()
+
+    def fill(self, data):
+        end = self.written + len(data)
+        if end > len(self.buf):
+            raise TemplateError(u"Output doesn't fit in the buffer.")
+        self.buf[self.written:end] = data
+        self.written = end
+
+    def flush(self):
+        if self.out is not None and self.buf:
+            self.out(bytes(self.buf))
+            self.written += len(self.buf)
+            del self.buf[:]
+
+    def getvalue(self):
+        return bytes(self.buf)
+
+
+class LRUCache(object):
+    """\
+    A thread safe mapping that holds at most `size` entries and drops
+    the least recently used entry to make room for new ones. A size
+    of 0 disables the cache: nothing is stored and every get misses.
+
+    The `hits`, `misses` and `evictions` counters are meant to help
+    pick a size.
+    """
+    # Entries are kept in a circular doubly linked list of
+    # [prev, next, key, value] lists, oldest first.
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, size=256):
+        self.size = size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getstate__(self):
+        # Only the size survives pickling, the entries are dropped.
+        return {"size": self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state["size"])
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.data.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[self.VALUE]
+
+    def put(self, key, value):
+        with self.lock:
+            link = self.data.get(key)
+            if link is not None:
+                link[self.VALUE] = value
+                self._unlink(link)
+                self._append(link)
+                return
+            if self.size <= 0:
+                return
+            while len(self.data) >= self.size:
+                self._evict()
+            link = [None, None, key, value]
+            self.data[key] = link
+            self._append(link)
+
+    def discard(self, key):
+        with self.lock:
+            link = self.data.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            while len(self.data) > max(size, 0):
+                self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.data = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "entries": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def _append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+
+    def _unlink(self, link):
+        prev, succ = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT], succ[self.PREV] = succ, prev
+
+    def _evict(self):
+        link = self.root[self.NEXT]
+        self._unlink(link)
+        del self.data[link[self.KEY]]
+        self.evictions += 1
+
+
+# Templates built from the output of lambdas and callable values, shared
+# by every TemplateOptions that doesn't set `lambda_cache`.
+LAMBDA_CACHE = LRUCache(256)
+
+
+class Resolver(object):
+    """\
+    Finds names in context values for `ContextStack.lookup`. A value is
+    first indexed with the name and then asked for an attribute of that
+    name, and what works for a type is learned once for all its values:
+
+    - Types that can't be indexed with a name, like objects without
+      `__getitem__`, lists, tuples and named tuples, go straight to the
+      attribute lookup instead of raising and catching a TypeError.
+    - Plain dicts use `dict.get`.
+    - For types whose attributes are fixed by the type, like builtins,
+      named tuples and classes with `__slots__`, names the type doesn't
+      have are remembered as misses.
+
+    Accessors for other types can be added with `register`.
+    """
+    # Builtin types known to implement plain attribute access.
+    PLAIN_TYPES = set([object, dict, list, tuple, str, unicode, int, long,
+                        float, bool, type(None), set, frozenset])
+    # Indexing these with a name always raises TypeError.
+    SEQUENCE_ITEMS = set([list.__getitem__, tuple.__getitem__,
+                        str.__getitem__, unicode.__getitem__])
+
+    def __init__(self):
+        self.registered = {}
+        self.accessors = {}
+
+    def __reduce__(self):
+        # The default resolver stays the default one once unpickled.
+        if self is RESOLVER:
+            return "RESOLVER"
+        return (Resolver, (), {"registered": self.registered.copy()})
+
+    def __setstate__(self, state):
+        self.registered = state["registered"]
+
+    def register(self, cls, func):
+        """\
+        Use `func(value, name, default)` to look names up in values of
+        type `cls` and its subclasses. It returns `default` for names
+        that aren't found.
+        """
+        self.registered[cls] = func
+        self.accessors = {}
+
+    def accessor(self, cls):
+        """\
+        Return the function `func(value, name)` used for values of type
+        `cls`. It returns NOT_FOUND for names that aren't found.
+        """
+        try:
+            return self.accessors[cls]
+        except KeyError:
+            pass
+        for base in getattr(cls, "__mro__", (cls,)):
+            func = self.registered.get(base)
+            if func is not None:
+                ret = lambda ctx, name: func(ctx, name, NOT_FOUND)
+                break
+        else:
+            ret = self.learn(cls)
+        self.accessors[cls] = ret
+        return ret
+
+    def learn(self, cls):
+        items = (hasattr(cls, "__getitem__")
+                    and cls.__getitem__ not in self.SEQUENCE_ITEMS)
+        fixed = self.fixed(cls)
+        misses = {}
+
+        def attr(ctx, name):
+            if name in misses:
+                return NOT_FOUND
+            ret = getattr(ctx, name, NOT_FOUND)
+            if ret is NOT_FOUND and fixed and not hasattr(cls, name):
+                misses[name] = True
+            return ret
+
+        if cls is dict:
+            def access(ctx, name):
+                ret = ctx.get(name, NOT_FOUND)
+                if ret is NOT_FOUND:
+                    return attr(ctx, name)
+                return ret
+        elif items:
+            def access(ctx, name):
+                try:
+                    return ctx[name]
+                except (TypeError, KeyError, IndexError):
+                    return attr(ctx, name)
+        else:
+            access = attr
+        return access
+
+    def fixed(self, cls):
+        # Instances without a __dict__ only have the attributes of their
+        # type, unless attribute access is customized.
+        if getattr(cls, "__dictoffset__", None) != 0:
+            return False
+        if hasattr(cls, "__getattr__"):
+            return False
+        for base in getattr(cls, "__mro__", (cls,)):
+            if "__getattribute__" in base.__dict__:
+                if base not in self.PLAIN_TYPES:
+                    return False
+        return True
+
+
+# The resolver used unless the `resolver` option is set.
+RESOLVER = Resolver()
+
+
+def register_accessor(cls, func):
+    """\
+    Register `func` with the default resolver, see `Resolver.register`.
+    """
+    RESOLVER.register(cls, func)
+
+
 class TemplateOptions(object):
     """\
     An class that represents the options provided to a template during
@@ -247,42 +1162,531 @@ class TemplateOptions(object):
                       `str.decode` accepts.
         errors      - The action to take for decoding errors. Default is
                       `replace` but can be anything that `str.decode` accepts.
+        compile     - Render through a Python function generated from the
+                      parsed template instead of walking the node tree.
+                      Default is False.
+        cache       - An instance of TemplateCache or the path of a directory
+                      to use as one. Parsed and compiled templates are stored
+                      there and reused by every process sharing the directory.
+                      Default is None.
+        lambda_cache - An LRUCache holding the templates parsed from the
+                      output of lambdas and callable values, so that a lambda
+                      returning the same text again doesn't need to be
+                      reparsed. Default is the module level LAMBDA_CACHE.
+                      Set to None to disable caching.
+        inline_partials - Splice the nodes of partials into the templates
+                      using them the first time those are rendered, instead
+                      of looking partials up on every render. Recursive
+                      partials are still looked up when rendered. Default
+                      is False.
+        resolver    - The Resolver used to look names up in context values.
+                      Default is the module level RESOLVER.
+        fragment_cache - A FragmentCache storing the output of {{*name}}
+                      sections and of the sections it names. Default is
+                      None.
+        parallel    - A ParallelRenderer rendering the items of the sections
+                      it names in parallel. Default is None.
+        budget      - A RenderBudget limiting every render of the template
+                      that isn't given one of its own. Default is None.
     """
     def __init__(self, opts):
         self.extension = opts.get("extension", ".mustache")
         self.lookup = opts.get("lookup", None)
         self.charset = opts.get("charset", "utf-8")
         self.encoding_errors = opts.get("encoding-errors", "replace")
+        self.compile = opts.get("compile", False)
+        self.cache = opts.get("cache", None)
+        if isinstance(self.cache, basestring):
+            self.cache = TemplateCache(self.cache)
+        self.lambda_cache = opts.get("lambda_cache", LAMBDA_CACHE)
+        self.inline_partials = opts.get("inline_partials", False)
+        self.resolver = opts.get("resolver", RESOLVER)
+        self.fragment_cache = opts.get("fragment_cache", None)
+        self.parallel = opts.get("parallel", None)
+        self.budget = opts.get("budget", None)
 
     def get(self, name, default):
         return getattr(self, name, default)
 
+    def fingerprint(self):
+        """\
+        A tuple of the options that change the result of parsing or
+        compiling a template.
+        """
+        return (
+            self.compile,
+            self.get(u"otag", DEF_OTAG),
+            self.get(u"ctag", DEF_CTAG),
+            tuple(self.get(u"any_content", ANY_CONTENT)),
+            tuple(self.get(u"skip_whitespace", SKIP_WHITESPACE)),
+            self.get(u"tag_content", TAG_CONTENT_RE),
+            tuple(sorted(getattr(self.fragment_cache, "sections", None) or ())),
+            tuple(sorted(getattr(self.parallel, "sections", None) or ()))
+        )
+
+
+class TemplateCache(object):
+    """\
+    A directory of parsed templates that can be shared by several
+    processes. Each entry holds the node tree of a template, and the
+    code of its compiled render function if the template is compiled,
+    serialized with `marshal`.
+
+    Entries are keyed by a hash of the template source, the options that
+    affect parsing, the cache format and the Python bytecode version, so
+    a changed template simply misses and stale entries are never read.
+    Entries are written to a temporary file and renamed into place so
+    readers never see a partial write. Unreadable entries are removed
+    and the template is parsed again.
+
+    directory   - The directory to store entries in. It is created if
+                  it does not exist.
+    """
+    VERSION = 1
+    SUFFIX = ".tmpl"
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process may have beaten us to it.
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def key(self, data, opts):
+        digest = hashlib.sha1()
+        digest.update(imp.get_magic())
+        digest.update(repr((self.VERSION, opts.fingerprint())))
+        digest.update(data.encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def load(self, key):
+        try:
+            with open(self.path(key), "rb") as handle:
+                data = handle.read()
+        except (IOError, OSError):
+            return None
+        try:
+            version, entry = marshal.loads(data)
+            if version == self.VERSION:
+                return entry
+        except (EOFError, ValueError, TypeError):
+            pass
+        self.discard(key)
+        return None
+
+    def store(self, key, entry):
+        data = marshal.dumps((self.VERSION, entry))
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            try:
+                with os.fdopen(fd, "wb") as handle:
+                    handle.write(data)
+                os.rename(tmpname, self.path(key))
+            except (IOError, OSError):
+                # Renaming over an existing file fails on some platforms
+                # but in that case another process already stored the
+                # same entry.
+                os.unlink(tmpname)
+        except (IOError, OSError):
+            pass
+
+    def discard(self, key):
+        try:
+            os.unlink(self.path(key))
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        for fname in os.listdir(self.directory):
+            if fname.endswith(self.SUFFIX):
+                self.discard(fname[:-len(self.SUFFIX)])
+
+
+class MemoryFragmentStore(object):
+    """\
+    A FragmentCache store keeping outputs in an LRUCache, each until it
+    expires. Outputs are shared by the threads of a process.
+
+    size        - The maximum number of outputs to keep.
+    """
+    def __init__(self, size=1024):
+        self.cache = LRUCache(size)
+        self.expired = 0
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires is not None and expires <= time.time():
+            self.cache.discard(key)
+            self.expired += 1
+            return None
+        return data
+
+    def put(self, key, data, ttl=None):
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        self.cache.put(key, (expires, data))
+
+    def discard(self, key):
+        self.cache.discard(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        ret = self.cache.stats()
+        ret["expired"] = self.expired
+        return ret
+
+
+class FileFragmentStore(TemplateCache):
+    """\
+    A FragmentCache store keeping each output in a file of `directory`,
+    so that every process using the directory shares them. Point it at
+    a memory backed file system such as /dev/shm to share outputs
+    through memory. Entries are written like TemplateCache entries and
+    expired ones are removed when they are read.
+    """
+    SUFFIX = ".frag"
+
+    def get(self, key):
+        entry = self.load(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires is not None and expires <= time.time():
+            self.discard(key)
+            return None
+        return data
+
+    def put(self, key, data, ttl=None):
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        self.store(key, (expires, data))
+
+
+class FragmentCache(object):
+    """\
+    Holds the rendered output of the sections that are cached, see the
+    `fragment_cache` template option.
+
+    store       - Where outputs are kept: a MemoryFragmentStore, a
+                  FileFragmentStore or any object with `get(key)` and
+                  `put(key, data, ttl)` methods. Default is a new
+                  MemoryFragmentStore.
+    sections    - A dict of the names of the {{#name}} sections to cache
+                  to what their output depends on. {{*name}} sections are
+                  cached whether they are named here or not. Outputs are
+                  keyed on the source and name of their section and, for
+                  the sections named here, either the values of a sequence
+                  of names looked up in the context or the value returned
+                  by a function called with a `get(name)` function that
+                  looks names up in the context. The value of the section
+                  itself is not part of the key.
+    ttl         - The number of seconds outputs are kept for, or None to
+                  keep them until the store drops them. Default is 300.
+
+    The `hits` and `misses` counters, also returned by `stats` along with
+    those of the store, show how well the cache is doing.
+    """
+    def __init__(self, store=None, sections=None, ttl=300):
+        if store is None:
+            store = MemoryFragmentStore()
+        self.store = store
+        self.sections = sections or {}
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, node, ctx):
+        spec = self.sections.get(node.name)
+        if spec is None:
+            values = ()
+        elif callable(spec):
+            values = spec(ctx.get)
+        else:
+            values = tuple(ctx.get(name) for name in spec)
+        # Misses are keyed alike in every process.
+        if isinstance(values, tuple):
+            values = tuple(None if v is NOT_FOUND else v for v in values)
+        content = node.template.sub_data(node.start, node.end)
+        digest = hashlib.sha1()
+        digest.update(node.name.encode("utf-8"))
+        digest.update(content.encode("utf-8"))
+        digest.update(repr(values))
+        return digest.hexdigest()
+
+    def get(self, key):
+        ret = self.store.get(key)
+        if ret is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ret
+
+    def put(self, key, data):
+        self.store.put(key, data, self.ttl)
+
+    def stats(self):
+        ret = {}
+        if hasattr(self.store, "stats"):
+            ret.update(self.store.stats())
+        ret.update(hits=self.hits, misses=self.misses)
+        return ret
+
+
+class ParallelRenderer(object):
+    """\
+    Renders the items of large sections in parallel, see the `parallel`
+    template option.
+
+    executor    - A `concurrent.futures` executor. Use a process pool for
+                  CPU bound sections, in which case the template, the
+                  items and the context values used in the section must
+                  be picklable as they are sent along with each chunk.
+    sections    - The names of the {{#name}} sections to render in
+                  parallel.
+    chunksize   - The number of items rendered by each task.
+    max_pending - The maximum number of chunks submitted and not yet
+                  written. Items are read from the section value as
+                  chunks are written, so a generator of items is never
+                  read far ahead.
+
+    Sections nested in a parallel section, parallel ones and those of
+    recursive partials included, are rendered by the task rendering
+    their chunk, so tasks never submit chunks of their own and wait on
+    them. The executor is also dropped when the options are pickled.
+    """
+    def __init__(self, executor, sections, chunksize=1000, max_pending=8):
+        self.executor = executor
+        self.sections = set(sections)
+        self.chunksize = chunksize
+        self.max_pending = max(max_pending, 1)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["executor"] = None
+        return state
+
+    def chunks(self, node, outer, frame, raises, items):
+        """\
+        Render the content of `node` for each of `items` on top of the
+        `outer` values and the section value `frame`, yielding the output
+        of each chunk of items in order. Lookups that miss raise
+        ContextMiss when `raises` is set.
+        """
+        items = iter(items)
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < self.max_pending:
+                    chunk = list(itertools.islice(items, self.chunksize))
+                    if not chunk:
+                        break
+                    pending.append(self.executor.submit(render_items,
+                                        node, outer, frame, raises, chunk))
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+
 
 class TemplateInfo(object):
     """\
     An internal class that represents a template loaded from disk
     for use by the TemplateLoader to keep track of loaded Templates.
+
+    When `check_fs` is set the file is stat'ed at most once every
+    `check_interval` seconds and the template is only reparsed if its
+    modification time, size or inode changed. Watched templates skip
+    the stat entirely and rely on `invalidate` being called instead.
+
+    Getting the template doesn't lock unless it has to be reloaded, in
+    which case the first thread to get the lock reloads it and the
+    others use the reloaded template.
     """
-    def __init__(self, fname, check_fs, tmpl_opts):
+    def __init__(self, fname, check_fs, tmpl_opts, check_interval=0,
+                    watched=False):
         self.fname = fname
         self.check_fs = check_fs
+        self.check_interval = check_interval
+        self.watched = watched
         self.tmpl_opts = tmpl_opts
         self.lock = threading.Lock()
         self.template = None
-        self.mtime = None
+        self.stat = None
+        self.checked = 0
+        self.stale = False
         self.load_template()
 
     def get_template(self):
-        with self.lock:
-            if not self.check_fs:
-                return self.template
-        return self.load_template()
+        if self.check_fs and self.changed():
+            with self.lock:
+                # Another thread may have reloaded it meanwhile.
+                if self.stale or self.signature() != self.stat:
+                    self._load()
+        return self.template
 
     def load_template(self):
         with self.lock:
-            self.mtime = os.stat(self.fname).st_mtime
-            self.template = Template(filename=self.fname, opts=self.tmpl_opts)
-            return self.template
+            return self._load()
+
+    def invalidate(self):
+        self.stale = True
+
+    def changed(self):
+        if self.stale:
+            return True
+        if self.watched:
+            return False
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return False
+        self.checked = now
+        return self.signature() != self.stat
+
+    def signature(self):
+        st = os.stat(self.fname)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _load(self):
+        # Reset the flag and stat the file before reading it so that
+        # a change that races with the read is seen by the next check.
+        self.stale = False
+        stat = self.signature()
+        try:
+            template = Template(filename=self.fname, opts=self.tmpl_opts)
+        except:
+            # Keep the old template out of reach until the file loads,
+            # so a broken edit fails on every access until it is fixed.
+            self.stale = True
+            raise
+        self.stat = stat
+        self.checked = time.time()
+        self.template = template
+        return template
+
+
+class InotifyWatcher(object):
+    """\
+    Watches directories with Linux inotify from a daemon thread and
+    calls `callback(path)` for every file that is written, replaced,
+    moved or removed in them. Use `InotifyWatcher.available()` to
+    check for support before creating one.
+
+    Exceptions raised by the callback don't stop the thread. The last
+    few are kept in `errors` as (path, exception) pairs.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+            IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.libc = self.load_libc()
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.errors = deque(maxlen=16)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @staticmethod
+    def load_libc():
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            return hasattr(cls.load_libc(), "inotify_init")
+        except (OSError, TypeError):
+            return False
+
+    def watch(self, dirname):
+        with self.lock:
+            if dirname in self.watches.values():
+                return
+            path = dirname
+            if isinstance(path, unicode):
+                path = path.encode(sys.getfilesystemencoding() or "utf-8")
+            wd = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.watches[wd] = dirname
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, inst:
+                if inst.errno == errno.EINTR:
+                    continue
+                return
+            pos = 0
+            while pos + self.EVENT.size <= len(data):
+                wd, mask, cookie, size = self.EVENT.unpack_from(data, pos)
+                pos += self.EVENT.size
+                name = data[pos:pos+size].rstrip("\0")
+                pos += size
+                dirname = self.watches.get(wd)
+                if dirname is None or not name:
+                    continue
+                if isinstance(dirname, unicode):
+                    name = name.decode(sys.getfilesystemencoding() or "utf-8")
+                path = os.path.join(dirname, name)
+                try:
+                    self.callback(path)
+                except Exception, inst:
+                    self.errors.append((path, inst))
+
+
+class PendingLoad(object):
+    """\
+    A template being loaded by one thread that other threads wait for.
+    Waiting returns None if the loading thread was interrupted.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result):
+        self.result = result
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
 
 
 class TemplateLookup(object):
@@ -310,47 +1714,197 @@ class TemplateFileLookup(TemplateLookup):
                   allows users to dispense repeating filename extensions
                   when requesting templates (or in partials).
     check_fs    - Whether to recheck the filesystem to see if a template
-                  has changed. This check is based on file modification
-                  time.
+                  has changed. A template is only reparsed if the
+                  modification time, size or inode of its file changed.
     tmpl_opts   - Passed as the opts keyword arg to the Template constructor.
+                  Setting its `cache` option lets processes that use the
+                  same directories share parsed templates.
+    check_interval - When checking the filesystem, the minimum number of
+                  seconds between two checks of the same file.
+    watch       - Use inotify to get notified of template changes instead
+                  of checking the filesystem on access. Implies `check_fs`.
+                  Falls back to checking the filesystem where inotify is
+                  not available.
     """
-    def __init__(self, directories, ext=None, check_fs=False, tmpl_opts=None):
+    def __init__(self, directories, ext=None, check_fs=False, tmpl_opts=None,
+                    check_interval=0, watch=False):
 
         if isinstance(directories, basestring):
             directories = [directories]
         self.directories = [self.process_dir(d) for d in directories]
         
-        self.recheck_fs = recheck_fs
+        self.check_fs = check_fs or watch
+        self.check_interval = check_interval
+        self.watcher = None
+        if watch and InotifyWatcher.available():
+            self.watcher = InotifyWatcher(self.invalidate)
 
-        extension = extension or ".mustache"
+        extension = ext or ".mustache"
         if extension[:1] != ".":
             extension = "." + extension
+        self.extension = extension
         if tmpl_opts is None:
             tmpl_opts = {}
         tmpl_opts.setdefault("extension", extension)
         tmpl_opts.setdefault("lookup", self)
         self.tmpl_opts = TemplateOptions(tmpl_opts)
         
+        # Loaded templates are read without locking. The lock guards
+        # `loading`, the templates being loaded for the first time.
         self.templates = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Loaded templates, the lock and the watcher belong to this
+        # process. Unpickled lookups check the filesystem instead of
+        # watching it.
+        state = self.__dict__.copy()
+        state.update(templates={}, loading={}, lock=None, watcher=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
         self.lock = threading.Lock()
 
     def get_template(self, name):
-        with self.lock:
-            tinfo = self.templates.get(name, None)
-        if tinfo is not None:
-            return tinfo.get_template()
-        return self.load_template(name).get_template()
+        tinfo = self.templates.get(name)
+        if tinfo is None:
+            tinfo = self.load_template(name)
+        tmpl = tinfo.get_template()
+        if self.check_fs and tmpl.deps:
+            # A template with inlined partials is stale as soon as
+            # one of those partials is.
+            for dep, used in tmpl.deps.iteritems():
+                if self.load_template(dep).get_template() is not used:
+                    tinfo.invalidate()
+                    return tinfo.get_template()
+        return tmpl
 
     def load_template(self, name):
+        """\
+        Return the TemplateInfo for `name`, loading it if needed. When
+        several threads load the same template at once only the first
+        one parses it and the others wait for its result. Different
+        templates load in parallel.
+        """
+        tinfo = self.templates.get(name)
+        if tinfo is not None:
+            return tinfo
         with self.lock:
-            try:
-                return self.templates[name]
-            except KeyError:
-                pass
-            fname = self.find_template(name)
-            tinfo = TemplateInfo(fname, self.check_fs, self.tmpl_opts)
-            self.templates[name] = tinfo
+            tinfo = self.templates.get(name)
+            if tinfo is not None:
+                return tinfo
+            pending = self.loading.get(name)
+            if pending is None:
+                pending = self.loading[name] = PendingLoad()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            tinfo = pending.wait()
+            if tinfo is None:
+                # The loading thread was interrupted, try again.
+                return self.load_template(name)
             return tinfo
+        tinfo = error = None
+        try:
+            fname = self.find_template(name)
+            if self.watcher is not None:
+                self.watcher.watch(os.path.dirname(fname))
+            tinfo = TemplateInfo(fname, self.check_fs, self.tmpl_opts,
+                        check_interval=self.check_interval,
+                        watched=self.watcher is not None)
+        except Exception, inst:
+            error = inst
+            raise
+        finally:
+            # Waiters are released however the load ends, including by
+            # KeyboardInterrupt or SystemExit.
+            with self.lock:
+                if tinfo is not None:
+                    self.templates[name] = tinfo
+                del self.loading[name]
+            if error is not None:
+                pending.fail(error)
+            else:
+                pending.finish(tinfo)
+        return tinfo
+
+    def preload(self, freeze=True):
+        """\
+        Load every template found in the directories of this lookup, for
+        servers that fork workers after loading. Templates are parsed,
+        their partials inlined with the `inline_partials` option and
+        compiled with the `compile` option, so that workers share them
+        instead of each loading its own copy.
+
+        Every template is tried and the ones that fail to parse, or that
+        use partials that can't be found, are reported together by
+        raising a PreloadError afterwards, without freezing. Returns the
+        names of the templates loaded otherwise.
+
+        With `freeze` set the garbage collector is run once everything
+        is loaded. Python 2 has no `gc.freeze`, so there that is all it
+        does: the templates are parsed up front and the garbage they
+        leave is collected, but full collections in the workers still
+        visit, and write to, the pages holding them. Workers that want
+        those pages left alone can call `gc.disable()` after the fork
+        and `gc.collect()` between requests when they can afford it.
+        Where `gc.freeze` exists everything allocated so far is also
+        moved out of the collector's reach. Reference counts change as
+        templates are rendered either way.
+        """
+        names = []
+        errors = []
+        # Names found in several directories load the first of them,
+        # whether it loads or not.
+        tried = set()
+        for d in self.directories:
+            for dirname, dirs, files in os.walk(d):
+                dirs.sort()
+                for fname in sorted(files):
+                    if not fname.endswith(self.extension):
+                        continue
+                    path = os.path.join(dirname, fname)
+                    name = os.path.relpath(path, d)[:-len(self.extension)]
+                    if name in tried:
+                        continue
+                    tried.add(name)
+                    try:
+                        self.preload_template(name)
+                    except (PystacheError, IOError, OSError), inst:
+                        errors.append((name, inst))
+                    else:
+                        names.append(name)
+        if errors:
+            raise PreloadError(errors)
+        if freeze:
+            gc.collect()
+            if hasattr(gc, "freeze"):
+                gc.freeze()
+        return names
+
+    def preload_template(self, name):
+        tmpl = self.load_template(name).get_template()
+        for node in tmpl.walk(tmpl.parsed):
+            if node.__class__ is Partial:
+                node.template.get_partial(node.name)
+        if tmpl.opts.inline_partials and tmpl.deps is None:
+            tmpl.inline()
+        if tmpl.opts.compile:
+            tmpl.compile()
+        return tmpl
+
+    def invalidate(self, fname):
+        """\
+        Make the next access to any template loaded from `fname` reparse
+        it. Called by the watcher when a file changes.
+        """
+        fname = self.process_dir(fname)
+        for tinfo in self.templates.values():
+            if tinfo.fname == fname:
+                tinfo.invalidate()
 
     def find_template(self, name):
         for d in self.directories:
@@ -364,122 +1918,411 @@ class TemplateFileLookup(TemplateLookup):
                     return fn
         raise LookupError("Failed to find template: %s" % name)
 
-    def process_dir(d):
+    def process_dir(self, d):
         return os.path.normpath(os.path.abspath(d))
 
 
 class TemplateDictLookup(TemplateLookup):
     """\
     An implementation of TemplateLookup that retrieves template data
-    from a provided dict of templates. This class should not be used
-    in production because it does not cache templates and must reparse
-    each template everytime it is loaded.
+    from a provided dict of templates.
+
+    Parsed templates are kept in an LRU cache. A cached template is
+    reused for as long as the dict holds the same source for its name,
+    either the very same object or a string with the same content, so
+    the dict can be updated freely.
+
+    partials    - The dict of template names to template sources.
+    tmpl_opts   - Passed as the opts keyword arg to the Template constructor.
+    cache_size  - The maximum number of parsed templates to keep. Set to
+                  0 to reparse each template everytime it is loaded.
     """
-    def __init__(self, partials, tmpl_opts=None):
+    def __init__(self, partials, tmpl_opts=None, cache_size=256):
         self.partials = partials
 
         tmpl_opts = tmpl_opts or {}
         tmpl_opts.setdefault("lookup", self)
         self.tmpl_opts = TemplateOptions(tmpl_opts)
 
+        self.cache = LRUCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
     def get_template(self, name):
+        tmpl = self.load_template(name)
+        if tmpl.deps:
+            # A template with inlined partials is stale as soon as
+            # one of those partials is.
+            for dep, used in tmpl.deps.iteritems():
+                if self.load_template(dep) is not used:
+                    self.cache.discard(name)
+                    return self.load_template(name)
+        return tmpl
+
+    def load_template(self, name):
         if name not in self.partials:
             raise LookupError("Failed to find template: %s" % name)
-        return Template(data=self.partials[name], opts=self.tmpl_opts)
+        data = self.partials[name]
+        entry = self.cache.get(name)
+        if entry is not None:
+            source, digest, tmpl = entry
+            if source is data:
+                self.hits += 1
+                return tmpl
+            if digest == self.digest(data):
+                self.hits += 1
+                self.cache.put(name, (data, digest, tmpl))
+                return tmpl
+            self.invalidations += 1
+        self.misses += 1
+        tmpl = Template(data=data, opts=self.tmpl_opts)
+        self.cache.put(name, (data, self.digest(data), tmpl))
+        return tmpl
+
+    def digest(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        return hashlib.sha1(data).digest()
+
+    def stats(self):
+        ret = self.cache.stats()
+        ret.update({
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations
+        })
+        return ret
 
 
-class ContextProxy(object):
+class ContextStack(object):
     """\
-    This object manages the access to a context variable that is used
-    to answer queries for tag names in a template. When a template is
-    rendered this class answers requests for attributes or items
-    contained in the user supplied data.
+    This object manages the access to the context values that are used
+    to answer queries for tag names in a template. The user supplied
+    data is at the bottom of the stack. Sections push the value of their
+    tag and then each item they iterate over, and dotted names push the
+    values of all but their last name, for as long as they render.
+
+    Lookups search the stack from the top down, looking for items then
+    attributes, and return the values found as is. A lookup that finds
+    nothing returns NOT_FOUND, or raises ContextMiss when `should_raise`
+    is set or one of the values on the stack has a true `RAISE_ON_MISS`
+    attribute.
     """
-    def __init__(self, template, ctx, parent, should_raise):
+    def __init__(self, template, ctx, should_raise=False):
         self.template = template
-        self.ctx = ctx
-        self.parent = parent
-        if hasattr(ctx, u"RAISE_ON_MISS"):
-            self.should_raise = ctx.RAISE_ON_MISS or should_raise
-        else:
-            self.should_raise = should_raise
-
-    def render(self, writer, escaped=True):
-        if self._should_call(args=0):
-            data = self.cached = self.template.decode(self.ctx())
-            tmpl = self.template.sub_template(data=data)
-            data = tmpl.render(self)
-        else:            
-            data = self.template.decode(self.ctx)
-        if escaped:
-            data = cgi.escape(data, quote=True)
-        writer.write(data)
+        self.resolver = template.opts.resolver
+        self.frames = [ctx]
+        self.should_raise = should_raise
+        self.push = self.frames.append
+        self.pop = self.frames.pop
+
+    @classmethod
+    def wrap(cls, template, context, budget=None):
+        """\
+        Return a stack for rendering `template` with `context`, which
+        may already be a stack when rendering partials. A BudgetStack
+        is used when a RenderBudget is given.
+        """
+        if isinstance(context, ContextStack):
+            return context
+        if budget is not None:
+            return BudgetStack(template, context, budget)
+        return cls(template, context)
+
+    def limit(self, writer):
+        """\
+        Return the writer to render to instead of `writer`. Subclasses
+        wrap it to watch the output.
+        """
+        return writer
 
     def get(self, name):
-        parts = name.split(".")
-        ret = self
-        while len(parts):
-            ret = ret._lookup(parts.pop(0))
+        plan = split_name(name)
+        ret = self.resolve(plan)
+        self.unwind(len(plan[1]) - 1)
         return ret
 
-    def falsy(self):
-        return not bool(self.ctx)
-
-    def islambda(self):
-        return self._should_call(args=1)
-
-    def iterate(self):
-        items = []
-        if isinstance(self.ctx, basestring) or hasattr(self.ctx, "items"):
-            items = [self.ctx]
-        else:
-            try:
-                items = iter(self.ctx)
-            except TypeError:
-                items = [items]
-        for item in items:
-            yield ContextProxy(self.template, item, self, self.should_raise)
+    def resolve(self, plan):
+        """\
+        Look up the names of `plan` in turn and return the value of the
+        last one. The values of the others are left on the stack for the
+        caller to `unwind`.
+        """
+        hops, parts = plan
+        ret = self.lookup(parts[0], hops)
+        for part in parts[1:]:
+            self.push(ret)
+            ret = self.lookup(part)
+        return ret
 
-    def execute(self, content, ctx, writer):
-        tmpl = self.template.sub_template(data=self.ctx(content))
-        tmpl.render(ctx, writer=writer)
+    def unwind(self, count):
+        if count:
+            del self.frames[-count:]
 
-    def _lookup(self, name):
+    def lookup(self, name, hops=0):
         # Check for accessing up the stack using
         # the name^^ syntax. Each ^ means we want
-        # to remove a stack element.
-        proxy = self
-        while name[-1:] == "^" and ctx.parent is not None:
-            proxy = proxy.parent
-            name = name[:-1]
-        # Remove any trailing markers.
-        name = name.rstrip("^")
-
-        ret = NOT_FOUND
-        while proxy is not None:
-            try:
-                ret = proxy.ctx[name]
+        # to skip a stack element.
+        frames = self.frames
+        accessors = self.resolver.accessors
+        idx = max(len(frames) - 1 - hops, 0)
+        while idx >= 0:
+            ctx = frames[idx]
+            access = accessors.get(type(ctx))
+            if access is None:
+                access = self.resolver.accessor(type(ctx))
+            ret = access(ctx, name)
+            if ret is not NOT_FOUND:
                 break
-            except (TypeError, KeyError, IndexError):
-                pass
-            if ret is NOT_FOUND:
-                ret = getattr(proxy.ctx, name, NOT_FOUND)
-            if ret is NOT_FOUND:
-                proxy = proxy.parent
-                continue
-            break
-        if ret is NOT_FOUND and self.should_raise:
+            idx -= 1
+        if ret is NOT_FOUND and self.raises():
             raise ContextMiss(name)
-        return ContextProxy(self.template, ret, self, self.should_raise)
-
-    def _should_call(self, args=0):
-        func = self.ctx
-        if isinstance(func, (types.BuiltinFunctionType, types.FunctionType)):
-            return func.func_code.co_argcount == args
-        elif isinstance(func, (types.BuiltinMethodType, types.MethodType)):
-            return func.func_code.co_argcount - 1 == args
+        if is_future(ret):
+            ret = ret.result()
+        return ret
+
+    def raises(self):
+        if self.should_raise:
+            return True
+        for ctx in self.frames:
+            if getattr(ctx, "RAISE_ON_MISS", False):
+                return True
+        return False
+
+    def peek(self, name):
+        """\
+        Return the value of `name` in the top context alone, as is, or
+        NOT_FOUND.
+        """
+        ctx = self.frames[-1]
+        return self.resolver.accessor(type(ctx))(ctx, name)
+
+    def write(self, value, writer, escaped=True):
+        if should_call(value, args=0):
+            data = self.call_lambda(value)
+            tmpl = self.template.lambda_template(data)
+            # Lambda results are usually rendered once so they're not
+            # worth compiling. Always use the tree walker for them.
+            buf = Writer()
+            self.push(value)
+            tmpl.root.render(self, buf)
+            self.pop()
+            data = buf.getvalue()
+        elif escaped and is_safe(value):
+            writer.write(self.template.decode(value.__html__()))
+            return
         else:
-            return callable(func)
+            data = self.template.decode(value)
+        if escaped:
+            data = escape(data)
+        writer.write(data)
+
+    def call_lambda(self, value):
+        """\
+        Return the decoded result of `value`, a lambda written by a
+        value tag, which is then rendered with `value` pushed on the
+        stack.
+        """
+        return self.template.decode(value())
+
+    def islambda(self, value):
+        return should_call(value, args=1)
+
+    def iterate(self, value):
+        if isinstance(value, basestring) or hasattr(value, "items"):
+            return [value]
+        try:
+            return iter(value)
+        except TypeError:
+            return [[]]
+
+    def execute(self, value, content, writer):
+        tmpl = self.template.lambda_template(value(content))
+        tmpl.root.render(self, writer)
+
+    def count_items(self, count):
+        """\
+        Called with the number of section items rendered without going
+        through `iterate`, such as the rows of Columns.
+        """
+        pass
+
+    def render_partial(self, name, tmpl, writer):
+        return tmpl.render(self, writer)
+
+    def stream_partial(self, name, tmpl, writer):
+        return tmpl.stream(self, writer)
+
+
+class RenderBudget(object):
+    """\
+    Limits on the resources a single render may use, for templates that
+    can't be trusted to be reasonable. A render that goes over one of
+    them stops with BudgetExceeded.
+
+    max_bytes       - The size of the output, in characters, or in bytes
+                      for `Template.render_bytes`. Output is checked
+                      before it is written so it never goes over.
+    max_iterations  - The number of section items rendered, over all the
+                      sections.
+    max_partial_depth - How deep partials may include each other. Only
+                      partials looked up at render time count, those
+                      spliced in by the `inline_partials` option can't
+                      recurse.
+    timeout         - The number of seconds the render may take, checked
+                      every few section items and on each partial and
+                      lambda.
+
+    Limits left to None aren't checked. A budget holds no state, the
+    same one can be used by any number of renders at once.
+    """
+    # The deadline is checked once per this many section items.
+    CHECK_EVERY = 16
+
+    def __init__(self, max_bytes=None, max_iterations=None,
+                    max_partial_depth=None, timeout=None, clock=time.time):
+        self.max_bytes = max_bytes
+        self.max_iterations = max_iterations
+        self.max_partial_depth = max_partial_depth
+        self.timeout = timeout
+        self.clock = clock
+
+
+def unlimited(value):
+    if value is None:
+        return float("inf")
+    return value
+
+
+class BudgetWriter(object):
+    """\
+    Passes writes on to another writer once the BudgetStack has taken
+    their size from its budget. Writers with a `write_bytes` method,
+    like ByteWriter, are charged the encoded size of the output.
+    """
+    def __init__(self, target, stack):
+        self.target = target
+        self.stack = stack
+        self.out = target.write
+        if hasattr(target, "write_bytes"):
+            self.out = target.write_bytes
+            self.write = self.encode
+
+    def write(self, data):
+        # Called for every fragment of output, so the check is inlined.
+        stack = self.stack
+        size = stack.written + len(data)
+        if size > stack.max_bytes:
+            stack.exceeded("max_bytes")
+        stack.written = size
+        self.out(data)
+
+    write_bytes = write
+
+    def encode(self, data):
+        target = self.target
+        self.write_bytes(data.encode(target.charset, target.errors))
+
+
+class BudgetStack(ContextStack):
+    """\
+    The ContextStack used for renders with a RenderBudget. It counts the
+    output, section items and partials of a render and raises
+    BudgetExceeded as soon as one of them goes over the budget. Renders
+    without a budget use a plain ContextStack and pay nothing.
+    """
+    def __init__(self, template, ctx, budget):
+        super(BudgetStack, self).__init__(template, ctx)
+        self.budget = budget
+        self.max_bytes = unlimited(budget.max_bytes)
+        self.max_iterations = unlimited(budget.max_iterations)
+        self.max_partial_depth = unlimited(budget.max_partial_depth)
+        self.clock = budget.clock
+        self.started = self.clock()
+        self.deadline = self.started + unlimited(budget.timeout)
+        self.written = 0
+        self.iterations = 0
+        self.partials = []
+
+    def progress(self):
+        """\
+        Return how far the render got: the output size in `bytes`, the
+        section `iterations`, the names of the `partials` being rendered,
+        outermost first, and the seconds `elapsed`.
+        """
+        return {
+            "bytes": self.written,
+            "iterations": self.iterations,
+            "partials": list(self.partials),
+            "elapsed": self.clock() - self.started
+        }
+
+    def exceeded(self, limit):
+        raise BudgetExceeded(limit, self.progress())
+
+    def check_time(self):
+        if self.clock() > self.deadline:
+            self.exceeded("timeout")
+
+    def limit(self, writer):
+        if writer.__class__ is BudgetWriter and writer.stack is self:
+            return writer
+        return BudgetWriter(writer, self)
+
+    def iterate(self, value):
+        return self.count(super(BudgetStack, self).iterate(value))
+
+    def count(self, items):
+        every = self.budget.CHECK_EVERY
+        for item in items:
+            if self.iterations >= self.max_iterations:
+                self.exceeded("max_iterations")
+            self.iterations += 1
+            if not self.iterations % every:
+                self.check_time()
+            yield item
+
+    def count_items(self, count):
+        if self.iterations + count > self.max_iterations:
+            self.exceeded("max_iterations")
+        self.iterations += count
+        self.check_time()
+
+    def checked(self, data):
+        # Lambda results are parsed and rendered before being written,
+        # so runaway ones are stopped on their size alone. Results that
+        # aren't strings are left to fail, or not, as they would without
+        # a budget.
+        self.check_time()
+        if (isinstance(data, basestring)
+                and self.written + len(data) > self.max_bytes):
+            self.exceeded("max_bytes")
+        return data
+
+    def call_lambda(self, value):
+        return self.checked(super(BudgetStack, self).call_lambda(value))
+
+    def execute(self, value, content, writer):
+        data = self.checked(value(content))
+        super(BudgetStack, self).execute(lambda c: data, content, writer)
+
+    def enter(self, name):
+        if len(self.partials) >= self.max_partial_depth:
+            self.exceeded("max_partial_depth")
+        self.check_time()
+        self.partials.append(name)
+
+    def render_partial(self, name, tmpl, writer):
+        self.enter(name)
+        tmpl.render(self, writer)
+        self.partials.pop()
+
+    def stream_partial(self, name, tmpl, writer):
+        self.enter(name)
+        for step in tmpl.stream(self, writer):
+            yield step
+        self.partials.pop()
 
 
 class Tokenizer(object):
@@ -487,9 +2330,19 @@ class Tokenizer(object):
     Consumes a template source and generates a sequence of
     tokens that represent the various syntactical portions
     of the source.
+
+    Each tag is found and split into its parts with a single search
+    of a pattern built for the current delimiters. Compiled patterns
+    are shared by every tokenizer in the process.
     """
     TAG = object()
     STATIC = object()
+
+    # Templates that switch to many different delimiters could grow
+    # the pattern cache without bound so it is simply reset once it
+    # holds MAX_PATTERNS entries.
+    PATTERNS = {}
+    MAX_PATTERNS = 64
     
     def __init__(self, data, opts=None):
         if not isinstance(data, unicode):
@@ -497,151 +2350,111 @@ class Tokenizer(object):
                                             data.__class__.__name__)
         self.data = data
         self.opts = opts or {}
-        self.compiled = {}
-        self.re_match = None
         self.pos = 0
-        self.otag = re.escape(self.opts.get(u"otag", DEF_OTAG))
-        self.ctag = re.escape(self.opts.get(u"ctag", DEF_CTAG))
         self.any_content = set(self.opts.get(u"any_content", ANY_CONTENT))
         self.skip_ws = set(self.opts.get(u"skip_whitespace", SKIP_WHITESPACE))
         self.tag_content = self.opts.get(u"tag_content", TAG_CONTENT_RE)
-    
+        self.set_delimiters(self.opts.get(u"otag", DEF_OTAG),
+                                self.opts.get(u"ctag", DEF_CTAG))
+
+    @classmethod
+    def patterns(cls, otag, ctag, tag_content):
+        key = (otag, ctag, tag_content)
+        ret = cls.PATTERNS.get(key)
+        if ret is None:
+            source = TAG_RE % (re.escape(otag), re.escape(ctag))
+            ret = (
+                re.compile(source, re.MULTILINE | re.DOTALL),
+                re.compile(ur"^%s$" % tag_content),
+                re.compile(tag_content)
+            )
+            if len(cls.PATTERNS) >= cls.MAX_PATTERNS:
+                cls.PATTERNS.clear()
+            cls.PATTERNS[key] = ret
+        return ret
+
+    def set_delimiters(self, otag, ctag):
+        self.otag, self.ctag = otag, ctag
+        patterns = self.patterns(otag, ctag, self.tag_content)
+        self.tag_re, self.content_re, self.ctag_re = patterns
+
     def __iter__(self):
+        data = self.data
         while not self.eos():
-            pos = self.pos
-            for tag in self.parse_tag():
-                yield tag
-            if not self.eos():
-                static = self.parse_text()
-                if static:
-                    yield static
-            if self.pos <= pos:
-                raise self.error("Parser failed to progress.")
-    
-    def parse_tag(self):
-        # Only silence whitespace if this tag is the only non-whitespace
-        # content on the line and the tag type is in self.skip_ws
-        silence_ws = self.pos == 0 or self.data[self.pos-1] == u"\n"
-        
-        # Find the start of the next template tag.
-        match = self.match(ur"([ \t]+)?%s" % self.otag)
-        if not match:
-            return []
-        otag_match = self.re_match
-        ws_padding = otag_match.group(1) or ""
-        
-        # Detect the tag type if it exists.
-        tagtype = self.match(ur"\s*[%s]" % TAG_TYPES)
-        self.skip(ur"\s*")
+            match = self.tag_re.search(data, self.pos)
+            if match is None:
+                # A dangling open tag is the only way for the
+                # rest of the template not to be static text.
+                idx = data.find(self.otag, self.pos)
+                if idx >= 0:
+                    self.pos = idx + len(self.otag)
+                    self.error(u"Unclosed tag.")
+                yield (self.STATIC, self.rest())
+                return
+            if match.end() <= self.pos:
+                self.error(u"Parser failed to progress.")
+            start = match.start()
+            if start > self.pos:
+                yield (self.STATIC, data[self.pos:start])
+            for tok in self.parse_tag(match):
+                yield tok
+
+    def parse_tag(self, match):
+        data = self.data
+        groups = match.group("pad", "brace", "caret", "type", "content")
+        ws_padding, brace, caret, tagtype, content = groups
+        ws_padding = ws_padding or u""
+        tagtype = brace or caret or tagtype
 
-        # Get the content for the current tag by finding the close
-        # of the tag.
-        content = self.until(ur"\s*(%s)?%s" % (tagtype, self.ctag))
-        
         # Check that the tag name is valid if this isn't a comment
         # or tag switch.
         if tagtype not in self.any_content:
+            self.pos = match.end("content")
             if not content or not content.strip() and tagtype != u"^":
                 self.error(u"Empty tag.")
-            m = self.pattern(ur"^%s$" % self.tag_content).match(content)
-            if not m:
+            if not self.content_re.match(content):
                 self.error(u"Invalid tag content: %s" % content)
+        self.pos = match.end()
 
-        # Hack for prettier un-escape tags so that we
-        # have {{{foo}}} instead of {{{foo{}}
-        if tagtype == u"{":
-            tagtype = u"}"
-
-        # Skip space after content and optionally a repeated close
-        # tag type.
-        self.skip(ur"\s*(%s)?" % tagtype)
-        if not self.match(self.ctag):
-            self.error(u"Unclosed tag.")
-        ctag_match = self.re_match
-
-        # Unhack our un-escaped tag hack
-        if tagtype == u"}":
-            tagtype = u"{"
-        
-        # If a tag type in self.skip_ws the tag is the only non-whitespace
-        # content on that line, silence that line from the output.
+        # Only silence whitespace if this tag is the only non-whitespace
+        # content on the line and the tag type is in self.skip_ws
+        start = match.start()
+        silence_ws = start == 0 or data[start-1] == u"\n"
         if silence_ws:
-            match = self.pattern(ur"[ \t]*\n").match(self.data, self.pos)
-            if tagtype in self.skip_ws and match is not None:
-                self.skip(ur"[ \t]*\n")
+            eol = STANDALONE_RE.match(data, self.pos)
+            if tagtype in self.skip_ws and eol is not None:
+                self.pos = eol.end()
             else:
                 silence_ws = False
 
         ret = []
         if not silence_ws and len(ws_padding):
             ret.append((self.STATIC, ws_padding))
-        
+
         if tagtype == u"=":
             # Handle a tag update if we have one. This doesn't
             # generate a token for the parse stream.
             otag, ctag = content.split(u" ", 1)
-            m = self.pattern(self.tag_content).match(ctag)
+            m = self.ctag_re.match(ctag)
             if len(m.group(0)):
                 self.error(u"Invalid close tag: %s" % ctag)
-            self.otag, self.ctag = re.escape(otag), re.escape(ctag)
+            self.set_delimiters(otag, ctag)
         else:
             # Give coordinates where this tag resides in the template
             # data stream.
-            start = otag_match.start() + len(ws_padding)
-            end = ctag_match.end()
-            tag = Tag(tagtype, content, start, end)
+            tag = Tag(tagtype, content, start + len(ws_padding), match.end())
             ret.append((self.TAG, tag))
-        
+
         return ret
-    
-    def parse_text(self):
-        text = self.until(u"(^[ \t]+)?%s" % self.otag, re.MULTILINE)
-        # No match means rest is static
-        if text is None:
-            text = self.rest()
-        # If text is empty, silence the empty static node
-        if text:
-            return (self.STATIC, text)
-    
+
     def eos(self):
         return self.pos >= len(self.data)
-    
-    def match(self, pattern, flags=None):
-        self.re_match = self.pattern(pattern, flags).match(self.data, self.pos)
-        if not self.re_match:
-            return
-        self.pos = self.re_match.end()
-        return self.re_match.group(0)
 
-    def skip(self, pattern, flags=None):
-        self.re_match = self.pattern(pattern, flags).match(self.data, self.pos)
-        if not self.re_match:
-            return
-        self.pos = self.re_match.end()
-    
-    def until(self, pattern, flags=None):
-        self.re_match = self.pattern(pattern, flags).search(self.data, self.pos)
-        if not self.re_match:
-            return None
-        mstart = self.re_match.start()
-        ret = self.data[self.pos:mstart]
-        self.pos = mstart
-        return ret
-    
     def rest(self):
         ret = self.data[self.pos:]
         self.pos = len(self.data)
         return ret
 
-    def pattern(self, pattern, flags=None):
-        if flags is None:
-            flags = 0
-        ret = self.compiled.get((pattern, flags))
-        if ret is None:
-            ret = re.compile(pattern, flags)
-            self.compiled[(pattern, flags)] = ret
-        return ret
-
     def error(self, mesg):
         lines = self.data[:self.pos].splitlines()
         if not lines:
@@ -649,6 +2462,323 @@ class Tokenizer(object):
         raise ParseError(mesg, (len(lines), len(lines[-1])))
 
 
+class Compiler(object):
+    """\
+    Translates the node tree created by `Template.parse` into the source
+    of a single Python function. Static text is written inline, dotted
+    names are unrolled into chained lookups and sections loop directly
+    over their items.
+
+    The generated function takes the same `(ctx, writer)` arguments as
+    `Renderable.render` and expects the global names `tmpl` (the
+    template), `nodes` (the template's nodes in walk order), `escape`,
+    `unicode` and `Columns`. Partials and node types the compiler doesn't
+    know about are rendered by calling back into the node itself.
+
+    With `stream` set the function is a generator instead, that yields
+    after each section item like `Renderable.stream`. With `binary` set
+    static text is encoded with the template's charset when compiling and
+    passed to the `write_bytes` method of a ByteWriter.
+    """
+    # CPython refuses to compile more than twenty statically nested
+    # blocks or a hundred levels of indentation. Sections nested deeper
+    # than this are left to the tree walker.
+    MAX_LOOPS = 16
+    MAX_DEPTH = 64
+
+    def __init__(self, template, stream=False, binary=False):
+        self.template = template
+        self.stream = stream
+        self.binary = binary
+        self.order = {}
+        self.lines = []
+        self.loops = 0
+
+    def compile(self):
+        for idx, node in enumerate(self.template.walk()):
+            self.order[id(node)] = idx
+        self.emit(0, "def render(ctx, writer):")
+        self.emit(1, "write = writer.write")
+        if self.binary:
+            self.emit(1, "write_bytes = writer.write_bytes")
+        for name in ("lookup", "push", "pop", "islambda", "iterate"):
+            self.emit(1, "%s = ctx.%s" % (name, name))
+        self.emit_body(self.template.root, 1)
+        if self.stream:
+            self.emit(1, "yield None")
+        source = "\n".join(self.lines) + "\n"
+        fname = "<pystache %s>" % (self.template.filename or "template")
+        return compile(source, fname, "exec")
+
+    def emit(self, depth, line):
+        self.lines.append("    " * depth + line)
+
+    def resolve(self, plan, depth):
+        # Push the values of all but the last name, like
+        # ContextStack.resolve, and return the last lookup.
+        hops, parts = plan
+        for part in parts[:-1]:
+            self.emit(depth, "push(%s)" % self.lookup(part, hops))
+            hops = 0
+        return self.lookup(parts[-1], hops)
+
+    def lookup(self, name, hops):
+        if hops:
+            return "lookup(%r, %d)" % (name, hops)
+        return "lookup(%r)" % name
+
+    def unwind(self, plan, depth):
+        for part in plan[1][:-1]:
+            self.emit(depth, "pop()")
+
+    def emit_body(self, multi, depth):
+        mark = len(self.lines)
+        static = []
+        for node in self.flatten(multi.sects):
+            if node.__class__ is Static:
+                static.append(node.data)
+                continue
+            if static:
+                self.emit_static(u"".join(static), depth)
+                static = []
+            emit = getattr(self, "emit_%s" % node.__class__.__name__, None)
+            if emit is None:
+                emit = self.emit_node
+            emit(node, depth)
+        if static:
+            self.emit_static(u"".join(static), depth)
+        if len(self.lines) == mark:
+            self.emit(depth, "pass")
+
+    def emit_static(self, data, depth):
+        if self.binary:
+            opts = self.template.opts
+            data = data.encode(opts.get(u"charset", u"utf-8"))
+            self.emit(depth, "write_bytes(%r)" % data)
+        else:
+            self.emit(depth, "write(%r)" % data)
+
+    def flatten(self, sects):
+        # Inlined partials render in the context of the template
+        # using them so their nodes can be emitted as if they were
+        # part of it.
+        for node in sects:
+            if node.__class__ is Inline:
+                for sub in self.flatten(node.sects):
+                    yield sub
+            else:
+                yield node
+
+    def emit_node(self, node, depth):
+        if self.stream:
+            self.emit(depth, "for _ in nodes[%d].stream(ctx, writer):" %
+                                                self.order[id(node)])
+            self.emit(depth + 1, "yield _")
+        else:
+            self.emit(depth, "nodes[%d].render(ctx, writer)" %
+                                                self.order[id(node)])
+
+    def emit_Multi(self, node, depth):
+        self.emit_body(node, depth)
+
+    def emit_Value(self, node, depth):
+        # Plain unicode values, by far the most common, are written
+        # without going through ContextStack.write.
+        self.emit(depth, "v = %s" % self.resolve(node.plan, depth))
+        self.emit(depth, "if v.__class__ is unicode:")
+        if node.escaped:
+            self.emit(depth + 1, "write(escape(v))")
+        else:
+            self.emit(depth + 1, "write(v)")
+        self.emit(depth, "else:")
+        self.emit(depth + 1, "ctx.write(v, writer, %r)" % node.escaped)
+        self.unwind(node.plan, depth)
+
+    def emit_Section(self, node, depth):
+        if self.loops >= self.MAX_LOOPS or depth >= self.MAX_DEPTH:
+            return self.emit_node(node, depth)
+        content = node.template.sub_data(node.start, node.end)
+        self.emit(depth, "v = %s" % self.resolve(node.plan, depth))
+        self.emit(depth, "if v:")
+        self.emit(depth + 1, "push(v)")
+        self.emit(depth + 1, "if islambda(v):")
+        self.emit(depth + 2, "ctx.execute(v, %r, writer)" % content)
+        self.emit(depth + 1, "elif v.__class__ is Columns and "
+                    "nodes[%d].render_columns(ctx, v, writer):" %
+                                                self.order[id(node)])
+        self.emit(depth + 2, "pass")
+        self.emit(depth + 1, "else:")
+        self.emit(depth + 2, "for c in iterate(v):")
+        self.emit(depth + 3, "push(c)")
+        self.loops += 1
+        self.emit_body(node, depth + 3)
+        self.loops -= 1
+        self.emit(depth + 3, "pop()")
+        if self.stream:
+            self.emit(depth + 3, "yield None")
+        self.emit(depth + 1, "pop()")
+        self.unwind(node.plan, depth)
+
+    def emit_InvSection(self, node, depth):
+        if depth >= self.MAX_DEPTH:
+            return self.emit_node(node, depth)
+        self.emit(depth, "v = %s" % self.resolve(node.plan, depth))
+        self.emit(depth, "if not v:")
+        self.emit(depth + 1, "push(v)")
+        self.emit_body(node, depth + 1)
+        self.emit(depth + 1, "pop()")
+        self.unwind(node.plan, depth)
+
+
+class Scope(object):
+    """\
+    A part of a template rendered with the same values on top of the
+    context stack, as found by `Template.analyze`.
+
+    kind        - "template", "section", "invsection", "lambda" for the
+                  sections of values known to be lambdas, or "partial".
+    name        - The tag name of sections and partials, the filename of
+                  the template otherwise.
+    names       - The names of the tags directly in this scope, including
+                  the tags of its sections, as written and in order.
+    scopes      - The scopes of the sections and partials in this scope.
+    recursive   - Set for partials that include themselves, directly or
+                  not, which are only analyzed once.
+    missing     - Set for partials that couldn't be loaded.
+    """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.names = []
+        self.scopes = []
+        self.recursive = False
+        self.missing = False
+
+    def walk(self, parents=()):
+        """\
+        Yield this scope and the scopes below it, each along with the
+        tuple of scopes it is in.
+        """
+        yield self, parents
+        for scope in self.scopes:
+            for ret in scope.walk(parents + (self,)):
+                yield ret
+
+
+class Analysis(object):
+    """\
+    The context names used by a template and its partials, as returned
+    by `Template.analyze`. Names are found in the parsed templates so
+    the names read by the templates built from the output of lambdas
+    are not known.
+
+    root        - The Scope of the template.
+    lambdas     - The names of values known to be lambdas.
+    """
+    def __init__(self, template, lambdas=()):
+        self.template = template
+        self.lambdas = set(lambdas)
+        self.root = Scope("template", template.filename)
+        self.visit(template.parsed, self.root, [template])
+
+    def visit(self, multi, scope, templates):
+        for node in multi.sects:
+            if isinstance(node, (Value, Section, InvSection)):
+                if node.name not in scope.names:
+                    scope.names.append(node.name)
+            if node.__class__ is Partial:
+                sub = Scope("partial", node.name)
+                scope.scopes.append(sub)
+                try:
+                    tmpl = node.template.get_partial(node.name)
+                except PystacheError:
+                    sub.missing = True
+                    continue
+                if tmpl in templates:
+                    sub.recursive = True
+                else:
+                    self.visit(tmpl.parsed, sub, templates + [tmpl])
+            elif isinstance(node, Multi):
+                kind = "section"
+                if isinstance(node, InvSection):
+                    kind = "invsection"
+                elif node.name in self.lambdas:
+                    kind = "lambda"
+                sub = Scope(kind, node.name)
+                scope.scopes.append(sub)
+                self.visit(node, sub, templates)
+
+    def paths(self):
+        """\
+        Return the set of dotted paths read by the template. Names used
+        in a section are listed below the section name, as in
+        "items.price.amount", even though they are looked up in the
+        enclosing scopes when the items don't have them. Names with ^
+        are listed below the enclosing section.
+        """
+        ret = set()
+        for scope, parents in self.root.walk():
+            for name in scope.names:
+                ret.add(self.path(parents + (scope,), name))
+        return ret
+
+    def boundaries(self):
+        """\
+        Return a dict of the paths rendered through partials or lambdas
+        to the set of those, labelled like "partial:row" or "lambda:bold".
+        Values known to be lambdas are their own boundary.
+        """
+        ret = {}
+        for scope, parents in self.root.walk():
+            scopes = parents + (scope,)
+            labels = set(u"%s:%s" % (s.kind, s.name) for s in scopes
+                            if s.kind in ("partial", "lambda"))
+            for name in scope.names:
+                found = set(labels)
+                if name in self.lambdas:
+                    found.add(u"lambda:%s" % name)
+                if found:
+                    path = self.path(scopes, name)
+                    ret.setdefault(path, set()).update(found)
+        return ret
+
+    def names(self):
+        """\
+        Return the set of names that may be looked up in the context the
+        template is rendered with. Those are all the parts of the tag
+        names since the parts after the first are looked up through the
+        whole stack when the value before them doesn't have them.
+        """
+        ret = set()
+        for scope, parents in self.root.walk():
+            for name in scope.names:
+                ret.update(split_name(name)[1])
+        return ret
+
+    def project(self, context, extra=()):
+        """\
+        Return a dict of the values `context` has for `names` and the
+        `extra` names, with which the template renders like it does
+        with `context`. Names only used by the output of lambdas must be
+        passed as `extra`.
+        """
+        ctx = ContextStack(self.template, context)
+        ret = {}
+        for name in self.names().union(extra):
+            value = ctx.peek(name)
+            if value is not NOT_FOUND:
+                ret[name] = value
+        return ret
+
+    def path(self, scopes, name):
+        hops, parts = split_name(name)
+        prefix = [s.name for s in scopes if s.kind in ("section", "lambda")]
+        # Each ^ skips an enclosing section, up to the root.
+        if hops:
+            prefix = prefix[:max(len(prefix) - hops, 0)]
+        return u".".join(prefix + list(parts))
+
+
 class Template(object):
     """\
     A Template object is responsible for parsing the tokenized source
@@ -667,10 +2797,16 @@ class Template(object):
     opts        - Various configuration settings that control template
                   rendering. See the `TemplateOptions` class for a description
                   of the accepted options.
+    cache       - Set to False to bypass the `cache` option. Used for
+                  templates built from the output of lambdas.
     """
-    def __init__(self, data=None, filename=None, opts=None):
+    def __init__(self, data=None, filename=None, opts=None, cache=True):
         self.data = data
         self.filename = filename
+        self.code = None
+        self.func = None
+        self.variants = {}
+        self.deps = None
 
         if isinstance(opts, TemplateOptions):
             self.opts = opts
@@ -690,18 +2826,401 @@ class Template(object):
         if isinstance(self.data, str):
             self.data = self.decode(self.data)
 
-        self.root = self.parse(self.data)
-
-    def render(self, context, writer=None):
-        if not isinstance(context, ContextProxy):
-            context = ContextProxy(self, context, None, False)
+        if cache and self.opts.cache is not None:
+            self.root = self.load(self.opts.cache)
+        else:
+            self.root = self.parse(self.data)
+        self.parsed = self.root
+
+    def __getstate__(self):
+        # Compiled functions can't be pickled but the code they are
+        # made from can be marshalled.
+        state = self.__dict__.copy()
+        state.update(func=None, variants={})
+        if self.code is not None:
+            state["code"] = marshal.dumps(self.code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.code is not None:
+            self.code = marshal.loads(self.code)
+
+    def render(self, context, writer=None, budget=None):
+        """\
+        Render the template with `context` to `writer`, or return the
+        output. `budget` is a RenderBudget for this render, overriding
+        the `budget` option.
+        """
+        context = ContextStack.wrap(self, context,
+                                    budget or self.opts.budget)
+        if self.deps is None and self.opts.inline_partials:
+            self.inline()
+        if self.opts.compile:
+            render = self.compile()
+        else:
+            render = self.root.render
         if writer:
-            self.root.render(context, writer)
+            render(context, context.limit(writer))
         else:
             writer = Writer()
-            self.root.render(context, writer)
+            try:
+                render(context, context.limit(writer))
+            except BudgetExceeded, inst:
+                inst.output = writer.getvalue()
+                raise
             return writer.getvalue()
 
+    def render_many(self, contexts, workers=None, chunksize=64, ordered=True):
+        """\
+        Render the template for each context of the `contexts` iterable
+        using a pool of `workers` processes, yielding the output for
+        each of them. Outputs come in the order of `contexts` unless
+        `ordered` is False, in which case they come as they're ready.
+
+        The template is parsed, and compiled with the `compile` option,
+        once and handed to every worker when the pool starts. Contexts
+        are sent to the workers in chunks of `chunksize` and are read
+        from `contexts` as results come back, so that at most a couple
+        of chunks per worker are pending at a time. Contexts and outputs
+        must be picklable.
+
+        `workers` defaults to the number of CPUs. With 0 or 1 workers the
+        contexts are rendered in this process.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers <= 1:
+            for context in contexts:
+                yield self.render(context)
+            return
+        if self.opts.compile:
+            self.compile()
+        contexts = iter(contexts)
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                        initargs=(self,))
+        try:
+            pending = deque()
+            while True:
+                while len(pending) < workers * 2:
+                    chunk = list(itertools.islice(contexts, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(pool.apply_async(render_chunk, (chunk,)))
+                if not pending:
+                    break
+                if ordered:
+                    ok, ret = pending.popleft().get()
+                else:
+                    ok, ret = self.first_ready(pending).get()
+                if not ok:
+                    raise ret
+                for output in ret:
+                    yield output
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def first_ready(pending):
+        """\
+        Remove and return the first of the `pending` AsyncResults that
+        is ready, whether its task succeeded or not, waiting for one if
+        none is.
+        """
+        while True:
+            for result in pending:
+                if result.ready():
+                    pending.remove(result)
+                    return result
+            pending[0].wait(0.01)
+
+    def render_async(self, context, executor=None):
+        """\
+        Render the template once the futures it needs from `context` are
+        done, without waiting for them. Returns a `concurrent.futures`
+        future for the output.
+
+        The context values used by the tags outside of sections, and by
+        the section tags themselves, that are futures are collected up
+        front and the template is rendered when the last of them is
+        done. Rendering happens in `executor` when given, otherwise in
+        the thread that completed the last future. Futures deeper in the
+        context are waited on when they are looked up.
+        """
+        if futures is None:
+            raise TemplateError(u"render_async requires concurrent.futures")
+        ret = futures.Future()
+        context = ContextStack.wrap(self, context)
+        pending = []
+        for name in self.root_names([]):
+            val = context.peek(name)
+            if is_future(val):
+                pending.append((name, val))
+
+        def finish():
+            if not ret.set_running_or_notify_cancel():
+                return
+            try:
+                values = dict((name, fut.result()) for name, fut in pending)
+                context.push(values)
+                ret.set_result(self.render(context))
+            except Exception, inst:
+                ret.set_exception(inst)
+
+        lock = threading.Lock()
+        remaining = [len(pending) or 1]
+        def done(fut):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            if executor is not None:
+                executor.submit(finish)
+            else:
+                finish()
+
+        if not pending:
+            done(None)
+        for name, fut in pending:
+            fut.add_done_callback(done)
+        return ret
+
+    def root_names(self, seen):
+        """\
+        Return the names looked up in the context the template is
+        rendered with, in order: the first name of each tag outside of
+        sections and of the section tags. Partials are followed unless
+        their template is in `seen`.
+        """
+        ret = []
+        seen.append(self)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, (Value, Section, InvSection)):
+                hops, parts = node.plan
+                if not hops and parts[0] not in ret:
+                    ret.append(parts[0])
+            if node.__class__ is Partial:
+                try:
+                    tmpl = node.template.get_partial(node.name)
+                except PystacheError:
+                    continue
+                if tmpl not in seen:
+                    names = tmpl.root_names(seen)
+                    ret.extend(n for n in names if n not in ret)
+            elif isinstance(node, Multi) and not isinstance(node, Section):
+                stack.extend(reversed(node.sects))
+        return ret
+
+    def analyze(self, lambdas=()):
+        """\
+        Return an Analysis of the context names this template and its
+        partials use, by section scope, to find out which values a
+        context needs before building it. `lambdas` are the names of
+        values known to be lambdas, whose sections are reported as
+        boundaries like partials are.
+        """
+        return Analysis(self, lambdas)
+
+    def render_bytes(self, context, target=None, budget=None):
+        """\
+        Render the template encoded with its `charset` option, writing
+        straight into a byte buffer instead of joining unicode fragments
+        and encoding the result.
+
+        `target` is where the output goes: a file or socket, a bytearray
+        to append to, a memoryview to fill or a ByteWriter. Without a
+        target the output is returned as a string, otherwise the number
+        of bytes written is returned.
+
+        Byte rendering always goes through the compiled template so that
+        static text is encoded once, when the template is compiled.
+        `budget` is as for `render`, with the output counted in bytes.
+        """
+        context = ContextStack.wrap(self, context,
+                                    budget or self.opts.budget)
+        writer = target
+        if not isinstance(target, ByteWriter):
+            writer = ByteWriter(self.opts.get(u"charset", u"utf-8"), target)
+        start = writer.size
+        self.compile(binary=True)(context, context.limit(writer))
+        if writer is not target:
+            writer.flush()
+        if target is None:
+            return writer.getvalue()
+        return writer.size - start
+
+    def iter_render(self, context, chunk_size=8192, budget=None):
+        """\
+        Render the template as a generator of unicode chunks. Output is
+        handed out as soon as `chunk_size` characters have been written,
+        checking after each section item, so large lists don't have to
+        be rendered completely before the first chunk goes out. The
+        generator can be returned as is from a WSGI application once
+        its chunks are encoded. `budget` is as for `render`.
+        """
+        context = ContextStack.wrap(self, context,
+                                    budget or self.opts.budget)
+        writer = ChunkWriter()
+        for step in self.stream(context, context.limit(writer)):
+            if writer.size >= chunk_size:
+                yield writer.flush()
+        if writer.size:
+            yield writer.flush()
+
+    def stream(self, context, writer):
+        """\
+        Render the template to `writer` in steps, see `Renderable.stream`.
+        """
+        if self.deps is None and self.opts.inline_partials:
+            self.inline()
+        if self.opts.compile:
+            return self.compile(stream=True)(context, writer)
+        return self.root.stream(context, writer)
+
+    def compile(self, stream=False, binary=False):
+        """\
+        Return the function generated for this template by `Compiler`.
+        The function is built on first use and cached on the template.
+        The variants used by `stream` and `render_bytes` are built when
+        `stream` or `binary` are set.
+        """
+        if self.deps is None and self.opts.inline_partials:
+            self.inline()
+        if stream or binary:
+            func = self.variants.get((stream, binary))
+            if func is None:
+                code = Compiler(self, stream=stream, binary=binary).compile()
+                func = self.variants[(stream, binary)] = self.bind(code)
+            return func
+        if self.func is None:
+            if self.code is None:
+                self.code = Compiler(self).compile()
+            self.func = self.bind(self.code)
+        return self.func
+
+    def bind(self, code):
+        ns = {
+            "tmpl": self,
+            "nodes": list(self.walk()),
+            "escape": escape,
+            "unicode": unicode,
+            "Columns": Columns
+        }
+        exec code in ns
+        return ns["render"]
+
+    def load(self, cache):
+        """\
+        Return the root node for this template from `cache`, parsing
+        the template and storing it in the cache on a miss.
+        """
+        key = cache.key(self.data, self.opts)
+        entry = cache.load(key)
+        if entry is not None:
+            try:
+                root = self.restore(entry[0])
+                self.code = entry[1]
+                return root
+            except (PystacheError, IndexError, TypeError, ValueError):
+                cache.discard(key)
+        root = self.parse(self.data)
+        # Code compiled before partials are inlined would be thrown away.
+        if self.opts.compile and not self.opts.inline_partials:
+            self.root = root
+            self.code = Compiler(self).compile()
+        cache.store(key, (root.dump(), self.code))
+        return root
+
+    def restore(self, dump, parent=None):
+        """\
+        Rebuild a node tree from the output of `Renderable.dump`.
+        """
+        kind = dump[0]
+        if kind == "static":
+            return Static(self, dump[1])
+        elif kind == "value":
+            return Value(self, dump[1], escaped=dump[2])
+        elif kind == "partial":
+            return Partial(self, dump[1])
+        elif kind == "multi":
+            node = Multi(self, parent)
+        elif kind == "section":
+            node = Section(self, parent, dump[1], dump[2])
+            node.end = dump[3]
+        elif kind == "cachedsection":
+            node = CachedSection(self, parent, dump[1], dump[2])
+            node.end = dump[3]
+        elif kind == "parallelsection":
+            node = ParallelSection(self, parent, dump[1], dump[2])
+            node.end = dump[3]
+        elif kind == "invsection":
+            node = InvSection(self, parent, dump[1], dump[2])
+            node.end = dump[3]
+        else:
+            raise TemplateError(u"Unknown node type: %s" % kind)
+        for sect in dump[-1]:
+            node.add(self.restore(sect, node))
+        node.freeze()
+        return node
+
+    def inline(self):
+        """\
+        Replace the Partial nodes of this template with Inline nodes
+        holding the nodes of the partials, recursively. Partials that
+        include themselves, directly or not, or that fail to load are
+        left alone to be looked up at render time.
+
+        The partials that were inlined are recorded in `deps` so that
+        lookups can tell when this template is out of date.
+        """
+        deps = {}
+        self.root = self.expand(self.parsed, None, [self], [], deps)
+        self.code = None
+        self.func = None
+        self.variants = {}
+        self.deps = deps
+
+    def expand(self, node, parent, templates, names, deps):
+        if node.__class__ is Partial:
+            try:
+                tmpl = node.template.get_partial(node.name)
+            except PystacheError:
+                return node
+            if tmpl in templates or node.name in names:
+                return node
+            deps[node.name] = tmpl
+            ret = Inline(tmpl, parent, node.name)
+            templates, names = templates + [tmpl], names + [node.name]
+            for sect in tmpl.parsed.sects:
+                ret.add(self.expand(sect, ret, templates, names, deps))
+            ret.freeze()
+            return ret
+        elif isinstance(node, Multi):
+            # Nodes without partials below them are shared with the
+            # parsed tree, the others are copied.
+            ret = copy.copy(node)
+            ret.parent = parent
+            ret.sects = []
+            for sect in node.sects:
+                ret.add(self.expand(sect, ret, templates, names, deps))
+            if all(a is b for a, b in zip(ret.sects, node.sects)):
+                return node
+            ret.freeze()
+            return ret
+        return node
+
+    def walk(self, root=None):
+        stack = [root or self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            if isinstance(node, Multi):
+                stack.extend(reversed(node.sects))
+
     def get_partial(self, name):
         if self.opts.lookup:
             tmpl = self.opts.lookup.get_template(name)
@@ -709,14 +3228,16 @@ class Template(object):
             return tmpl
         elif self.filename is not None:
             dirname = os.path.dirname(self.filename)
-            fname = os.path.join(dirname, name + self.extension)
+            fname = os.path.join(dirname, name + self.opts.extension)
             if not os.path.exists(fname):
                 raise PartialNotFound(name)
-            return self.sub_template(filename=filename)
+            return self.sub_template(filename=fname)
         raise UnableToLoadPartials()
 
     def parse(self, data):
         tokenizer = Tokenizer(data, opts=self.opts)
+        cached = getattr(self.opts.fragment_cache, "sections", None) or {}
+        parallel = getattr(self.opts.parallel, "sections", None) or ()
         root = Multi(self, None)
         curr = root
         for tok in tokenizer:
@@ -725,8 +3246,17 @@ class Template(object):
             elif tok[1].tagtype == u"!":
                 # Ignore comments
                 pass
+            elif tok[1].tagtype == u"#" and tok[1].name in cached:
+                curr = curr.add(CachedSection(self, curr, tok[1].name,
+                                                tok[1].end))
+            elif tok[1].tagtype == u"#" and tok[1].name in parallel:
+                curr = curr.add(ParallelSection(self, curr, tok[1].name,
+                                                tok[1].end))
             elif tok[1].tagtype == u"#":
                 curr = curr.add(Section(self, curr, tok[1].name, tok[1].end))
+            elif tok[1].tagtype == u"*":
+                curr = curr.add(CachedSection(self, curr, tok[1].name,
+                                                tok[1].end))
             elif tok[1].tagtype == u"^" and tok[1].name:
                 curr = curr.add(InvSection(self, curr, tok[1].name, tok[1].end))
             elif tok[1].tagtype == u"^":
@@ -751,6 +3281,9 @@ class Template(object):
                 curr.add(Value(self, tok[1].name))
         if curr is not root:
             tokenizer.error("Unclosed section: %s" % curr.name)
+        for node in self.walk(root):
+            if isinstance(node, Multi):
+                node.freeze()
         return root
     
     def sub_template(self, data=None, filename=None, **kwargs):
@@ -759,6 +3292,24 @@ class Template(object):
         kwargs.setdefault("opts", self.opts)
         return Template(**kwargs)
     
+    def lambda_template(self, data):
+        """\
+        Return a sub-template for `data` returned by a lambda or callable
+        value, reusing the template parsed for the same output before
+        when the `lambda_cache` option is set.
+        """
+        cache = self.opts.lambda_cache
+        if cache is None:
+            return self.sub_template(data=data, cache=False)
+        # The options carry everything that affects parsing as well as
+        # the lookup used for partials so they're part of the key.
+        key = (data, self.opts)
+        tmpl = cache.get(key)
+        if tmpl is None:
+            tmpl = self.sub_template(data=data, cache=False)
+            cache.put(key, tmpl)
+        return tmpl
+
     def sub_data(self, start, end):
         return self.data[start:end]
     
@@ -773,7 +3324,373 @@ class Template(object):
             return unicode(val)
 
 
+class ProfileRecord(object):
+    """\
+    The statistics gathered by a Profiler for one template, partial,
+    section or value.
+
+    kind        - One of "template", "partial", "section", "invsection",
+                  "value" or the lowercased class name of other nodes.
+    name        - The tag name, or the template filename for templates.
+    filename    - The file of the template the node belongs to, or the
+                  name it was included by for partials without a file.
+    position    - The (line, column) of the tag in its template, if known.
+    calls       - How many times the node rendered.
+    total       - Seconds spent rendering the node, including the nodes
+                  below it.
+    own         - Seconds spent in the node itself, lookups and lambdas
+                  included.
+    items       - The number of times a section rendered its content.
+    written     - The number of characters written by the node, including
+                  the nodes below it.
+    misses      - The number of lookups of the node that found nothing.
+    """
+    def __init__(self, kind, name, filename=None, position=None):
+        self.kind = kind
+        self.name = name
+        self.filename = filename
+        self.position = position
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.items = 0
+        self.written = 0
+        self.misses = 0
+        # The number of renders of this node in progress, so recursive
+        # partials don't count their time twice.
+        self.active = 0
+
+    def label(self):
+        ret = u"%s:%s" % (self.kind, self.name)
+        return ret.replace(u";", u"_").replace(u" ", u"_")
+
+    def location(self):
+        ret = os.path.basename(self.filename or u"<template>")
+        if self.position is not None:
+            ret += u":%d:%d" % self.position
+        return ret
+
+
+class Probe(Renderable):
+    """\
+    Stands in for a node of a template rendered by a Profiler, timing
+    the node and the probes below it.
+    """
+    __slots__ = ("node", "record", "profiler")
+
+    def __init__(self, node, record, profiler):
+        self.node = node
+        self.record = record
+        self.profiler = profiler
+
+    def render(self, ctx, writer):
+        self.profiler.enter(self.record)
+        try:
+            self.node.render(ctx, writer)
+        finally:
+            self.profiler.leave(self.record)
+
+
+class PartialProbe(Probe):
+    """\
+    A Probe for a Partial node. The partial is rendered from its own
+    probed tree so that its nodes are profiled too.
+    """
+    __slots__ = ()
+
+    def render(self, ctx, writer):
+        self.profiler.enter(self.record)
+        try:
+            tmpl = self.node.template.get_partial(self.node.name)
+            self.profiler.tree(tmpl, self.node.name).render(ctx, writer)
+        finally:
+            self.profiler.leave(self.record)
+
+
+class ProbeBody(Renderable):
+    """\
+    Holds the content of a section rendered by a Profiler, counting the
+    items it is rendered for.
+    """
+    __slots__ = ("sects", "record")
+
+    def __init__(self, sects, record):
+        self.sects = sects
+        self.record = record
+
+    def render(self, ctx, writer):
+        self.record.items += 1
+        for sect in self.sects:
+            sect.render(ctx, writer)
+
+
+class CountingWriter(object):
+    """\
+    Passes writes on to another writer, counting the characters written.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        self.target.write(data)
+
+
+class ProfilingStack(ContextStack):
+    """\
+    The ContextStack used by a Profiler, which reports the lookups that
+    find nothing to it.
+    """
+    def __init__(self, template, ctx, profiler):
+        super(ProfilingStack, self).__init__(template, ctx)
+        self.profiler = profiler
+
+    def lookup(self, name, hops=0):
+        try:
+            ret = super(ProfilingStack, self).lookup(name, hops)
+        except ContextMiss:
+            self.profiler.miss()
+            raise
+        if ret is NOT_FOUND:
+            self.profiler.miss()
+        return ret
+
+
+class Profiler(object):
+    """\
+    Renders templates while recording, for each template, partial,
+    section and value, how often it rendered, how long it took, the
+    items it iterated over, the characters it wrote and the lookups
+    that missed. See `ProfileRecord` for the details.
+
+    Profiling doesn't touch the regular render paths, which stay as
+    fast as they are. Templates rendered through `Profiler.render` use
+    a copy of their node tree with a probe around each node instead.
+    The copy is always rendered by the tree walker, even for templates
+    with the `compile` option, and the probes add some time of their
+    own, so timings are best compared with each other. The output is
+    the same as the output of `Template.render`.
+
+    Statistics accumulate over renders until `clear` is called. A
+    profiler should only render one template at a time.
+
+    timer       - The function returning the current time in seconds.
+    """
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.records = {}
+        self.trees = {}
+        self.offsets = {}
+        self.names = {}
+        self.paths = {}
+        self.stack = []
+        self.writer = None
+
+    def clear(self):
+        self.records = {}
+        self.trees = {}
+        self.offsets = {}
+        self.names = {}
+        self.paths = {}
+
+    def render(self, template, context, writer=None):
+        """\
+        Render `template` with `context` like `Template.render` would,
+        recording the time spent in its nodes.
+        """
+        ret = None
+        if writer is None:
+            writer = ret = Writer()
+        if not isinstance(context, ContextStack):
+            context = ProfilingStack(template, context, self)
+        root = self.tree(template)
+        name = os.path.basename(template.filename or u"<template>")
+        record = self.record(("template", template), "template", name,
+                                template)
+        self.writer = CountingWriter(writer)
+        self.stack = []
+        try:
+            self.enter(record)
+            try:
+                root.render(context, self.writer)
+            finally:
+                self.leave(record)
+        finally:
+            self.writer = None
+        if ret is not None:
+            return ret.getvalue()
+
+    def results(self):
+        """\
+        Return the records gathered so far, slowest first.
+        """
+        ret = [r for r in self.records.itervalues() if r.calls]
+        ret.sort(key=lambda r: r.own, reverse=True)
+        return ret
+
+    def report(self, limit=None):
+        """\
+        Return a table of the records, slowest first, as a string.
+        """
+        lines = [u"%8s %10s %10s %8s %10s %7s  %s" % (u"calls", u"total ms",
+                    u"self ms", u"items", u"written", u"misses", u"node")]
+        for rec in self.results()[:limit]:
+            lines.append(u"%8d %10.3f %10.3f %8d %10d %7d  %s %s (%s)" % (
+                rec.calls, rec.total * 1000.0, rec.own * 1000.0, rec.items,
+                rec.written, rec.misses, rec.kind, rec.name, rec.location()))
+        return u"\n".join(lines) + u"\n"
+
+    def folded(self):
+        """\
+        Return the time spent in each stack of nodes as lines in the
+        folded format read by flame graph tools: the labels of the nodes
+        from the template down separated by semicolons, then a space and
+        the time spent in the last node in microseconds.
+        """
+        ret = []
+        for path, elapsed in sorted(self.paths.iteritems()):
+            ret.append(u"%s %d" % (u";".join(path), int(elapsed * 1e6)))
+        return ret
+
+    def tree(self, template, name=None):
+        """\
+        Return the probed copy of the node tree of `template`, which is
+        included as the partial `name` if given.
+        """
+        if name is not None and template.filename is None:
+            self.names.setdefault(template, name)
+        root = template.root
+        if template.deps is None and template.opts.inline_partials:
+            template.inline()
+            root = template.root
+        entry = self.trees.get(template)
+        if entry is None or entry[0] is not root:
+            entry = self.trees[template] = (root, self.wrap(root, template))
+        return entry[1]
+
+    def wrap(self, node, template):
+        if node.__class__ is Static:
+            return node
+        kind = node.__class__.__name__.lower()
+        if node.__class__ is Inline:
+            kind = "partial"
+        record = self.record(("node", node), kind,
+                    getattr(node, "name", u""), template, node)
+        if node.__class__ is Partial:
+            return PartialProbe(node, record, self)
+        if not isinstance(node, Multi):
+            return Probe(node, record, self)
+        if node.__class__ is Inline:
+            template = node.template
+        ret = copy.copy(node)
+        sects = tuple(self.wrap(sect, template) for sect in node.sects)
+        if isinstance(node, (Section, InvSection)):
+            sects = (ProbeBody(sects, record),)
+        ret.sects = sects
+        if node.__class__ is Multi:
+            return ret
+        return Probe(ret, record, self)
+
+    def record(self, key, kind, name, template, node=None):
+        ret = self.records.get(key)
+        if ret is None:
+            position = None
+            if node is not None:
+                offset = self.offset(template, node)
+                if offset is not None:
+                    position = self.position(template.data, offset)
+            filename = template.filename or self.names.get(template)
+            ret = ProfileRecord(kind, name, filename, position)
+            self.records[key] = ret
+        return ret
+
+    def offset(self, template, node):
+        # Nodes don't keep the positions of their tags so the template
+        # is tokenized again. Tags other than comments and closing tags
+        # create a node each, in the order the parsed tree is walked.
+        offsets = self.offsets.get(template)
+        if offsets is None:
+            offsets = self.offsets[template] = {}
+            tags = [tok[1] for tok in Tokenizer(template.data, template.opts)
+                        if tok[0] is Tokenizer.TAG
+                            and tok[1].tagtype not in (u"!", u"/")]
+            nodes = [n for n in template.walk(template.parsed)
+                        if n.__class__ not in (Static, Multi)]
+            for tag, parsed in zip(tags, nodes):
+                offsets[parsed] = tag.start
+        if node in offsets:
+            return offsets[node]
+        return getattr(node, "start", None)
+
+    def position(self, data, offset):
+        line = data.count(u"\n", 0, offset) + 1
+        return (line, offset - data.rfind(u"\n", 0, offset) - 1)
+
+    def enter(self, record):
+        record.active += 1
+        self.stack.append([record, self.timer(), self.writer.written, 0.0])
+
+    def leave(self, record):
+        now = self.timer()
+        start, written, children = self.stack.pop()[1:]
+        elapsed = now - start
+        record.active -= 1
+        record.calls += 1
+        record.own += elapsed - children
+        if not record.active:
+            record.total += elapsed
+            record.written += self.writer.written - written
+        if self.stack:
+            self.stack[-1][3] += elapsed
+        path = tuple(f[0].label() for f in self.stack) + (record.label(),)
+        self.paths[path] = self.paths.get(path, 0.0) + elapsed - children
+
+    def miss(self):
+        if self.stack:
+            self.stack[-1][0].misses += 1
+
+
 def render(template, context, **kwargs):
     t = Template(data=template, **kwargs)
     return t.render(context)
 
+
+# The template rendered by the worker processes of `Template.render_many`.
+WORKER_TEMPLATE = None
+
+
+def init_worker(tmpl):
+    global WORKER_TEMPLATE
+    WORKER_TEMPLATE = tmpl
+
+
+class ChunkStack(ContextStack):
+    """\
+    The ContextStack a chunk of the items of a ParallelSection renders
+    with. Parallel sections rendered on it render like a Section.
+    """
+    pass
+
+
+def render_items(node, outer, frame, raises, items):
+    # Renders a chunk of the items of a ParallelSection, with `frame`
+    # standing in for the section value.
+    ctx = ChunkStack(node.template, outer, should_raise=raises)
+    ctx.push(frame)
+    writer = Writer()
+    for item in items:
+        ctx.push(item)
+        Multi.render(node, ctx, writer)
+        ctx.pop()
+    return writer.getvalue()
+
+
+def render_chunk(contexts):
+    # Errors are returned rather than raised because the pool doesn't
+    # call back for failed tasks.
+    try:
+        return True, [WORKER_TEMPLATE.render(ctx) for ctx in contexts]
+    except Exception, inst:
+        return False, inst
+
@@ -0,0 +1,200 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import pystache
+
+
+def wait_for(check, timeout=5.0):
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Interrupted(BaseException):
+    pass
+
+
+class InotifyWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        if not pystache.InotifyWatcher.available():
+            self.skipTest("inotify is not available")
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def touch(self, name):
+        with open(os.path.join(self.dirname, name), "w") as handle:
+            handle.write("x")
+
+    def test_callback_errors_dont_stop_the_watcher(self):
+        seen = []
+        def callback(path):
+            if not seen:
+                seen.append(None)
+                raise ValueError("boom")
+            seen.append(os.path.basename(path))
+        watcher = pystache.InotifyWatcher(callback)
+        watcher.watch(self.dirname)
+        self.touch("first")
+        self.assertTrue(wait_for(lambda: watcher.errors))
+        self.touch("second")
+        self.assertTrue(wait_for(lambda: "second" in seen))
+        path, inst = watcher.errors[0]
+        self.assertEqual(os.path.basename(path), "first")
+        self.assertTrue(isinstance(inst, ValueError))
+        self.assertTrue(watcher.thread.is_alive())
+
+
+class TemplateFileLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirnames = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+
+    def tearDown(self):
+        for dirname in self.dirnames:
+            shutil.rmtree(dirname)
+
+    def write(self, dirname, name, data):
+        with open(os.path.join(dirname, name + ".mustache"), "w") as handle:
+            handle.write(data)
+
+    def test_failures_are_reported_once_per_name(self):
+        for dirname in self.dirnames:
+            self.write(dirname, "broken", "{{#open}}")
+            self.write(dirname, "fine", "{{name}}")
+        lookup = pystache.TemplateFileLookup(self.dirnames)
+        try:
+            lookup.preload(freeze=False)
+        except pystache.PreloadError, inst:
+            self.assertEqual([name for name, err in inst.errors], ["broken"])
+        else:
+            self.fail("PreloadError not raised")
+
+    def test_interrupted_loads_release_waiters(self):
+        self.write(self.dirnames[0], "page", "Hi {{name}}")
+        lookup = pystache.TemplateFileLookup(self.dirnames[0])
+        find_template = lookup.find_template
+        loaded = []
+        def load():
+            loaded.append(lookup.load_template("page"))
+        def interrupted(name):
+            lookup.find_template = find_template
+            waiter = threading.Thread(target=load)
+            waiter.daemon = True
+            waiter.start()
+            time.sleep(0.1)
+            raise Interrupted()
+        lookup.find_template = interrupted
+        self.assertRaises(Interrupted, lookup.load_template, "page")
+        self.assertTrue(wait_for(lambda: loaded))
+        self.assertEqual(loaded[0].get_template().render({"name": "you"}),
+                         u"Hi you")
+        self.assertEqual(lookup.loading, {})
+
+
+class Greeting(object):
+    # A lambda whose output uses its own attributes.
+    name = u"you"
+
+    def __call__(self):
+        return u"Hi {{name}}!"
+
+
+class RenderBudgetTest(unittest.TestCase):
+
+    def test_lambdas_render_alike_with_a_budget(self):
+        for compile in (False, True):
+            tmpl = pystache.Template(u"{{greeting}}",
+                                     opts={"compile": compile})
+            budget = pystache.RenderBudget(max_bytes=1000)
+            context = {"greeting": Greeting()}
+            self.assertEqual(tmpl.render(context), u"Hi you!")
+            self.assertEqual(tmpl.render(context, budget=budget), u"Hi you!")
+
+
+def run_with_timeout(func, timeout=30.0):
+    """\
+    Call `func` in a thread and return its result, or raise its error.
+    Fails the test instead of hanging when it doesn't return in time.
+    """
+    outcome = {}
+    def run():
+        try:
+            outcome["result"] = func()
+        except BaseException, inst:
+            outcome["error"] = inst
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise AssertionError("Timed out after %.0f seconds" % timeout)
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+class RenderManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpl = pystache.Template(u"<{{name}}>")
+
+    def test_unordered_outputs(self):
+        contexts = [{"name": i} for i in range(50)]
+        render = lambda: list(self.tmpl.render_many(contexts, workers=2,
+                                    chunksize=4, ordered=False))
+        outputs = run_with_timeout(render)
+        self.assertEqual(sorted(outputs),
+                         sorted(u"<%d>" % i for i in range(50)))
+
+    def test_unordered_failures_are_raised(self):
+        # Lambdas can't be pickled, so the chunk never reaches a worker.
+        contexts = [{"name": 1}, {"name": lambda: 2}]
+        for ordered in (True, False):
+            render = lambda: list(self.tmpl.render_many(contexts,
+                                    workers=2, chunksize=1, ordered=ordered))
+            try:
+                run_with_timeout(render)
+            except AssertionError:
+                raise
+            except Exception:
+                pass
+            else:
+                self.fail("render_many(ordered=%r) didn't raise" % ordered)
+
+
+class FragmentCacheTest(unittest.TestCase):
+
+    def test_sections_not_entered_arent_cached(self):
+        for compile in (False, True):
+            cache = pystache.FragmentCache()
+            tmpl = pystache.Template(u"[{{*s}}S{{/s}}]",
+                        opts={"fragment_cache": cache, "compile": compile})
+            for value, output in [(False, u"[]"), (True, u"[S]"),
+                                  ([], u"[]"), (True, u"[S]")]:
+                self.assertEqual(tmpl.render({"s": value}), output)
+            self.assertEqual(cache.stats()["hits"], 1)
+
+
+class AnalysisTest(unittest.TestCase):
+
+    def test_paths_of_names_with_hops(self):
+        tmpl = pystache.Template(u"{{#a}}{{#b}}{{#c}}"
+                                 u"{{x}}{{y^}}{{z^^}}{{w^^^}}{{v^^^^^}}"
+                                 u"{{/c}}{{/b}}{{/a}}")
+        self.assertEqual(tmpl.analyze().paths(),
+                         set([u"a", u"a.b", u"a.b.c", u"a.b.c.x",
+                              u"a.b.y", u"a.z", u"w", u"v"]))
+
+
+if __name__ == "__main__":
+    unittest.main()